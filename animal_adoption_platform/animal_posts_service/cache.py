@@ -0,0 +1,370 @@
+#animal_posts_service/cache.py
+import collections
+import concurrent.futures
+import hashlib
+import json
+import threading
+import time
+import uuid
+import zlib
+import redis
+from google.protobuf.message import DecodeError
+import animal_posts_pb2
+
+# cached values are protobuf messages behind a format version byte and a flags byte
+CACHE_FORMAT_VERSION = 1
+COMPRESSED = 0x01
+
+# delete the lease only if it is still held by the caller
+RELEASE_LEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def encode_message(message, compress_threshold):
+    data = message.SerializeToString()
+    flags = 0
+    if len(data) > compress_threshold:
+        data = zlib.compress(data)
+        flags |= COMPRESSED
+    return bytes([CACHE_FORMAT_VERSION, flags]) + data
+
+
+# decode a cached value, or return None for missing values, unknown formats and corrupt data
+def decode_message(payload, message_type):
+    if not payload or len(payload) < 2 or payload[0] != CACHE_FORMAT_VERSION:
+        return None
+    try:
+        data = payload[2:]
+        if payload[1] & COMPRESSED:
+            data = zlib.decompress(data)
+        return message_type.FromString(data)
+    except (zlib.error, DecodeError) as e:
+        print(f"Failed to decode cached value: {e}")
+        return None
+
+
+# coalesce concurrent calls for the same key into a single execution
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def in_flight(self, key):
+        return key in self._calls
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = concurrent.futures.Future()
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = func()
+        except Exception as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+LocalEntry = collections.namedtuple("LocalEntry", ["payload", "post_ids", "scopes", "expires_at"])
+
+
+# size-capped in-process LRU of serialized listing responses, dropped on invalidation or after ttl
+class LocalCache:
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version = 0
+        self._size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at < time.monotonic():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry.payload
+
+    def set(self, key, payload, post_ids, scopes, version):
+        if self.max_entries <= 0 or len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            if version != self.version:
+                return
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = LocalEntry(payload, frozenset(post_ids), frozenset(scopes), time.monotonic() + self.ttl)
+            self._size += len(payload)
+            # evict least recently used entries until both caps hold
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def invalidate(self, post_ids=(), scopes=()):
+        post_ids, scopes = set(post_ids), set(scopes)
+        with self._lock:
+            self.version += 1
+            stale = [key for key, entry in self._entries.items() if entry.post_ids & post_ids or entry.scopes & scopes]
+            for key in stale:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+            self._size = 0
+
+    def _pop(self, key):
+        self._size -= len(self._entries.pop(key).payload)
+
+
+# Redis cache of posts and of listing pages keyed by the generations of their filter scopes
+class AnimalCache:
+    def __init__(self, client, post_ttl, page_ttl, stale_ttl=3600, lease_ttl=5, poll_interval=0.05,
+                 local=None, channel="animals:invalidate", compress_threshold=1024):
+        self.client = client
+        self.compress_threshold = compress_threshold
+        self.local = local or LocalCache(0, 0, 0)
+        self.channel = channel
+        self.post_ttl = post_ttl
+        self.page_ttl = page_ttl
+        self.stale_ttl = stale_ttl
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.single_flight = SingleFlight()
+        self.release_lease = client.register_script(RELEASE_LEASE) if client is not None else None
+
+    @staticmethod
+    def post_key(post_id):
+        return f"animal:post:{post_id}"
+
+    @staticmethod
+    def generation_key(scope):
+        return f"animals:gen:{scope}"
+
+    @staticmethod
+    def query_scopes(status, location):
+        scopes = []
+        if status:
+            scopes.append(f"status:{status}")
+        if location:
+            scopes.append(f"location:{location}")
+        return scopes or ["all"]
+
+    @staticmethod
+    def post_scopes(post):
+        return ["all", f"status:{post.status}", f"location:{post.location}"]
+
+    # build the key of a listing page from the current generations of its scopes
+    def page_key(self, status="", location="", cursor="", page_size=0):
+        if self.client is None:
+            return None
+        scopes = self.query_scopes(status, location)
+        try:
+            generations = self.client.mget([self.generation_key(scope) for scope in scopes])
+        except redis.RedisError as e:
+            print(f"Failed to read cache generations: {e}")
+            return None
+
+        # a page is written under the generations read before the DB query, so a
+        # concurrent write that bumps them leaves the page unreachable instead of stale
+        query = hashlib.sha1(json.dumps([status, location, cursor, page_size]).encode()).hexdigest()
+        return f"animals:page:{query}:" + ".".join(str(int(g or 0)) for g in generations)
+
+    # the last copy of a page, kept across generations for stale-while-revalidate
+    @staticmethod
+    def stale_key(key):
+        return "animals:stale:" + key.split(":")[2]
+
+    @staticmethod
+    def lease_key(key):
+        return "animals:lease:" + key.split(":", 2)[2]
+
+    # return (posts, next_cursor, source), loading the page with loader() on a miss; deadline is
+    # the time.monotonic() by which the caller must answer, a wait for another replica stops there
+    def get_or_load_page(self, key, loader, deadline=None):
+        if key is None:
+            return (*loader(), "Database")
+
+        if cached := self.get_page(key):
+            return (*cached, "Redis")
+
+        # another thread of this replica is already loading the page
+        if self.single_flight.in_flight(key) and (stale := self.get_page(self.stale_key(key))):
+            return (*stale, "Redis (stale)")
+
+        return self.single_flight.do(key, lambda: self._load_page(key, loader, deadline))
+
+    def _load_page(self, key, loader, deadline=None):
+        lease_key = self.lease_key(key)
+        token = uuid.uuid4().hex
+        try:
+            leased = self.client.set(lease_key, token, nx=True, ex=self.lease_ttl)
+        except redis.RedisError as e:
+            print(f"Failed to acquire cache lease: {e}")
+            leased = True
+
+        if not leased:
+            # another replica holds the lease: serve the stale page or wait for the new one
+            if stale := self.get_page(self.stale_key(key)):
+                return (*stale, "Redis (stale)")
+
+            wait_until = time.monotonic() + self.lease_ttl
+            if deadline is not None:
+                wait_until = min(wait_until, deadline)
+            while (remaining := wait_until - time.monotonic()) > 0:
+                time.sleep(min(self.poll_interval, remaining))
+                if cached := self.get_page(key):
+                    return (*cached, "Redis")
+            # nobody waits for the page any more, so do not load it
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError("Request deadline passed while waiting for the cache lease")
+            # the lease holder died or is too slow, load the page ourselves
+
+        try:
+            posts, next_cursor = loader()
+            self.set_page(key, posts, next_cursor)
+            return posts, next_cursor, "Database"
+        finally:
+            if leased:
+                try:
+                    self.release_lease(keys=[lease_key], args=[token])
+                except redis.RedisError as e:
+                    print(f"Failed to release cache lease: {e}")
+
+    # return (posts, next_cursor) for a cached page, or None on a miss
+    def get_page(self, key):
+        if key is None:
+            return None
+        try:
+            page = decode_message(self.client.get(key), animal_posts_pb2.AnimalPageResponse)
+            if page is None:
+                return None
+            values = self.client.mget([self.post_key(post.postId) for post in page.posts]) if page.posts else []
+        except redis.RedisError as e:
+            print(f"Failed to read cached page: {e}")
+            return None
+
+        posts = [decode_message(value, animal_posts_pb2.AnimalPost) for value in values]
+        # one of the posts expired or was deleted, the page has to be rebuilt
+        if any(post is None for post in posts):
+            return None
+        return posts, page.next_cursor
+
+    def set_page(self, key, posts, next_cursor=""):
+        if key is None:
+            return
+        page = animal_posts_pb2.AnimalPageResponse(
+            posts=[animal_posts_pb2.AnimalPost(postId=post.postId) for post in posts],
+            next_cursor=next_cursor
+        )
+        page = encode_message(page, self.compress_threshold)
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            # rows read by a page load may be older than a body an update has written
+            # through since, so they only fill in posts missing from the cache
+            for post in posts:
+                self._write_post(pipe, post, nx=True)
+            pipe.set(key, page, ex=self.page_ttl)
+            pipe.set(self.stale_key(key), page, ex=self.stale_ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Failed to cache page: {e}")
+
+    def post_created(self, post):
+        self.posts_created([post])
+
+    def posts_created(self, posts):
+        scopes = {scope for post in posts for scope in self.post_scopes(post)}
+        self._write(posts, sorted(scopes))
+
+    def post_updated(self, old, new):
+        self.posts_updated([(old, new)])
+
+    # write through a list of (old, new) posts
+    def posts_updated(self, changes):
+        # pages are ordered by id, so only a status or location change moves a post
+        # between filtered listings
+        scopes = set()
+        for old, new in changes:
+            if old.status != new.status:
+                scopes |= {f"status:{old.status}", f"status:{new.status}"}
+            if old.location != new.location:
+                scopes |= {f"location:{old.location}", f"location:{new.location}"}
+        self._write([new for old, new in changes], sorted(scopes))
+
+    def post_deleted(self, post):
+        self.invalidate(post.postId, self.post_scopes(post))
+
+    # drop a post and bump the given scopes when the full new row is not at hand
+    def invalidate(self, post_id, scopes):
+        self.local.invalidate([post_id], scopes)
+        if self.client is None:
+            return
+        try:
+            pipe = self.client.pipeline()
+            pipe.delete(self.post_key(post_id))
+            for scope in scopes:
+                pipe.incr(self.generation_key(scope))
+            self._publish(pipe, [post_id], scopes)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Failed to invalidate cached post {post_id}: {e}")
+
+    def _write(self, posts, scopes):
+        post_ids = [post.postId for post in posts]
+        self.local.invalidate(post_ids, scopes)
+        if self.client is None:
+            return
+        try:
+            pipe = self.client.pipeline()
+            for post in posts:
+                self._write_post(pipe, post)
+            for scope in scopes:
+                pipe.incr(self.generation_key(scope))
+            self._publish(pipe, post_ids, scopes)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Failed to write cached posts {post_ids}: {e}")
+
+    def _publish(self, pipe, post_ids, scopes):
+        pipe.publish(self.channel, json.dumps({"ids": post_ids, "scopes": scopes}))
+
+    # apply invalidations published by every replica to the in-process cache
+    def listen_for_invalidations(self):
+        if self.client is None:
+            return None
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: self._on_invalidation})
+        return pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=self._on_listener_error)
+
+    def _on_invalidation(self, message):
+        data = json.loads(message["data"])
+        self.local.invalidate(data["ids"], data["scopes"])
+
+    def _on_listener_error(self, e, pubsub, thread):
+        # invalidations may have been missed while disconnected
+        print(f"Cache invalidation listener failed: {e}")
+        self.local.clear()
+        time.sleep(1)
+
+    def _write_post(self, pipe, post, nx=False):
+        pipe.set(self.post_key(post.postId), encode_message(post, self.compress_threshold), ex=self.post_ttl, nx=nx)
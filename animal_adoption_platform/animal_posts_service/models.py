@@ -1,4 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, func, text
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.dialects import postgresql  # registers the typed to_tsvector/websearch_to_tsquery functions
 
 db = SQLAlchemy()
 
@@ -9,5 +12,32 @@ animal_posts = db.Table('animal_posts',
     db.Column('description', db.Text, nullable=False),
     db.Column('location', db.String(100), nullable=False),
     db.Column('status', db.String(50), nullable=False),
-    db.Column('images', db.String(255), nullable=True)
+    db.Column('images', db.String(255), nullable=True),
+    # bumped by every update, lets a commit detect that the row changed since it was read
+    db.Column('version', db.Integer, nullable=False, server_default='1')
 )
+
+# Indexes backing the keyset pagination of GetAnimalsPage (filter column first, then id)
+db.Index('idx_animal_posts_status_id', animal_posts.c.status, animal_posts.c.id)
+db.Index('idx_animal_posts_location_id', animal_posts.c.location, animal_posts.c.id)
+
+# Document searched by SearchAnimals; the GIN index must be built on this exact expression.
+# The "simple" configuration does no stemming, so it works for posts in any language.
+SEARCH_CONFIG = text("'simple'::regconfig")
+search_document = func.to_tsvector(SEARCH_CONFIG, animal_posts.c.title.op('||')(text("' '")).op('||')(animal_posts.c.description))
+
+# Full-text and trigram (fuzzy location) indexes only exist on PostgreSQL
+event.listen(animal_posts, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+db.Index('idx_animal_posts_search', search_document, postgresql_using='gin').ddl_if(dialect='postgresql')
+db.Index('idx_animal_posts_location_trgm', animal_posts.c.location,
+         postgresql_using='gin', postgresql_ops={'location': 'gin_trgm_ops'}).ddl_if(dialect='postgresql')
+
+
+# create_all() and init.sql skip a table that already exists, so bring one made by an older release up to date
+def upgrade_schema(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text('ALTER TABLE animal_posts ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1'))
+    connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    for index in sorted(animal_posts.indexes, key=lambda index: index.name):
+        connection.execute(CreateIndex(index, if_not_exists=True))
@@ -2,7 +2,10 @@
 import grpc
 import animal_posts_pb2
 import animal_posts_pb2_grpc
-from models import db, animal_posts
+from models import db, animal_posts, SEARCH_CONFIG, search_document, upgrade_schema
+from cache import AnimalCache, LocalCache
+from transactions import TransactionStore
+from stats import PostStats
 from flask import Flask
 import time
 import requests
@@ -11,7 +14,15 @@ from prometheus_flask_exporter import PrometheusMetrics, NO_PREFIX
 import threading
 import redis
 import json
+import base64
+import contextlib
+import asyncio
 from redis import Redis
+import redis.asyncio
+from sqlalchemy import event, func, or_, select, tuple_
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import sessionmaker
+from prometheus_client import Gauge, Histogram
 
 # Initialize Redis client
 try:
@@ -32,6 +43,111 @@ metrics = PrometheusMetrics(app, defaults_prefix=NO_PREFIX)
 metrics.info('app_info', 'Application info', version='1.0.3')
 with app.app_context():
     db.create_all()
+    engine = db.engine
+    with engine.begin() as connection:
+        upgrade_schema(connection)
+
+# sessions bound straight to the pooled engine, so gRPC handlers need no Flask app context
+Session = sessionmaker(bind=engine)
+
+# connection pool health, exported on the same /metrics endpoint
+Gauge('db_pool_size', 'Connections kept open in the pool', registry=metrics.registry).set_function(engine.pool.size)
+Gauge('db_pool_checked_out', 'Connections currently checked out of the pool', registry=metrics.registry).set_function(engine.pool.checkedout)
+# QueuePool.overflow() counts up from -pool_size until the pool is exhausted
+Gauge('db_pool_overflow', 'Connections opened beyond the pool size', registry=metrics.registry).set_function(lambda: max(engine.pool.overflow(), 0))
+db_pool_wait_seconds = Histogram(
+    'db_pool_wait_seconds', 'Time spent waiting for a pooled connection',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5), registry=metrics.registry
+)
+
+
+@contextlib.contextmanager
+def db_session():
+    # time only the pool checkout; the transaction, and the statement timeout set when it
+    # begins, start with the session's first query
+    started = time.perf_counter()
+    with engine.connect() as connection:
+        db_pool_wait_seconds.observe(time.perf_counter() - started)
+        with Session(bind=connection) as session:
+            yield session
+
+# deadline of the request handled by the current worker thread
+request_deadline = threading.local()
+
+
+def mark_worker_thread():
+    request_deadline.worker = True
+
+
+# shared pool running RPC handlers, so timed-out requests do not pay for a new thread each
+worker_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=app.config['RPC_WORKER_POOL_SIZE'],
+    initializer=mark_worker_thread
+)
+
+
+# number of RPCs being handled, whether running or waiting for a worker
+class InFlightCounter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def track(self):
+        with self._lock:
+            self.value += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.value -= 1
+
+
+rpc_in_flight = InFlightCounter()
+Gauge('rpc_in_flight', 'RPCs being handled, running or queued', registry=metrics.registry).set_function(lambda: rpc_in_flight.value)
+Gauge('rpc_queue_depth', 'RPC tasks waiting for a worker thread', registry=metrics.registry).set_function(lambda: worker_pool._work_queue.qsize())
+
+
+@contextlib.contextmanager
+def deadline_scope(deadline):
+    request_deadline.value = deadline
+    try:
+        yield
+    finally:
+        request_deadline.value = None
+
+
+# push the remaining request time down to Postgres, so queries stop once nobody waits for them
+@event.listens_for(engine, "begin")
+def apply_statement_timeout(conn):
+    deadline = getattr(request_deadline, "value", None)
+    if deadline is None or conn.dialect.name != "postgresql":
+        return
+    remaining_ms = max(1, int((deadline - time.monotonic()) * 1000))
+    conn.exec_driver_sql(f"SET LOCAL statement_timeout = {remaining_ms}")
+
+# without Redis pub/sub the in-process cache would never hear about other replicas' writes
+local_cache = LocalCache(
+    max_entries=app.config['ANIMALS_L1_MAX_ENTRIES'] if redis_client is not None else 0,
+    max_bytes=app.config['ANIMALS_L1_MAX_BYTES'],
+    ttl=app.config['ANIMALS_L1_TTL']
+)
+animal_cache = AnimalCache(
+    redis_client,
+    post_ttl=app.config['ANIMALS_CACHE_POST_TTL'],
+    page_ttl=app.config['ANIMALS_CACHE_PAGE_TTL'],
+    stale_ttl=app.config['ANIMALS_CACHE_STALE_TTL'],
+    lease_ttl=app.config['ANIMALS_CACHE_LEASE_TTL'],
+    local=local_cache,
+    compress_threshold=app.config['ANIMALS_CACHE_COMPRESS_THRESHOLD']
+)
+# 2PC participant state lives in Redis so Commit and Rollback may reach any replica
+transaction_store = TransactionStore(
+    redis_client,
+    prepared_ttl=app.config['TXN_PREPARED_TTL'],
+    finished_ttl=app.config['TXN_FINISHED_TTL']
+)
+post_stats = PostStats(redis_client)
 
 
 def register_service(service_name, service_url):
@@ -44,19 +160,238 @@ def register_service(service_name, service_url):
         print(f"Failed to register service: {e}")
 
 
+# opaque pagination cursors wrap the last seen id
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(str(value).encode()).decode()
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return 0
+    # binascii.Error and UnicodeDecodeError are both ValueError subclasses
+    return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+
+
+# apply the optional status/location filters of a listing request
+def filter_posts(query, request):
+    if request.status:
+        query = query.where(animal_posts.c.status == request.status)
+    if request.location:
+        query = query.where(animal_posts.c.location == request.location)
+    return query
+
+
+# serve a listing response from the in-process cache, or build it and keep its serialized bytes
+def serve_locally_cached(query, response_type, scopes, build_response):
+    if payload := local_cache.get(query):
+        response = response_type.FromString(payload)
+        response.source = "Memory"
+        return response
+
+    version = local_cache.version
+    response = build_response()
+    if response.source != "Redis (stale)":
+        post_ids = [post.postId for post in response.posts]
+        local_cache.set(query, response.SerializeToString(), post_ids, scopes, version)
+    return response
+
+
+# build the ranked query of SearchAnimals, served by the full-text and trigram GIN indexes
+def search_posts(request):
+    conditions, rank = [], []
+    if request.query:
+        ts_query = func.websearch_to_tsquery(SEARCH_CONFIG, request.query)
+        conditions.append(search_document.op('@@')(ts_query))
+        rank.append(func.ts_rank_cd(search_document, ts_query))
+    if request.location:
+        pattern = "%" + request.location.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        # substring or similar-spelling match, e.g. "Valea Trandafirilor" for "trandafiri"
+        conditions.append(or_(
+            animal_posts.c.location.ilike(pattern, escape="\\"),
+            animal_posts.c.location.op('%')(request.location)
+        ))
+        rank.append(func.similarity(animal_posts.c.location, request.location))
+    if request.status:
+        conditions.append(animal_posts.c.status == request.status)
+
+    score = (rank[0] if len(rank) == 1 else rank[0] + rank[1]).label("rank")
+    return (
+        select(*animal_posts.c, score)
+        .where(*conditions)
+        .order_by(score.desc(), animal_posts.c.id.desc())
+    )
+
+
+# validate the paging of a SearchAnimals request, returning (offset, limit) or None once the error is set
+def search_window(request, context):
+    if not request.query and not request.location:
+        context.set_details('A query or a location is required')
+        context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+        return None
+
+    page_size = request.page_size or app.config['ANIMALS_PAGE_SIZE']
+    page_size = max(1, min(page_size, app.config['ANIMALS_MAX_PAGE_SIZE']))
+    try:
+        # results are ordered by rank, so the cursor is the offset of the next page
+        offset = decode_cursor(request.cursor)
+        if offset < 0:
+            raise ValueError(offset)
+    except ValueError:
+        context.set_details('Invalid cursor')
+        context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+        return None
+    # deep pages of a ranked search are rarely useful and cost a scan of every skipped row
+    return offset, min(page_size, app.config['ANIMALS_SEARCH_MAX_RESULTS'] - offset)
+
+
+# build a SearchAnimals page from up to limit + 1 ranked rows
+def search_page(posts, offset, limit):
+    next_cursor = encode_cursor(offset + limit) if len(posts) > limit else ""
+    return animal_posts_pb2.AnimalPageResponse(
+        posts=[to_animal_post(post) for post in posts[:limit]],
+        next_cursor=next_cursor,
+        source="Database"
+    )
+
+
+def post_counts_query():
+    return (
+        select(animal_posts.c.status, animal_posts.c.location, func.count())
+        .group_by(animal_posts.c.status, animal_posts.c.location)
+    )
+
+
+# count posts per (status, location) in the database
+def count_posts():
+    with db_session() as session:
+        return session.execute(post_counts_query()).fetchall()
+
+
+def to_stats_response(stats):
+    return animal_posts_pb2.StatsResponse(
+        total=stats["total"],
+        by_status=stats["by_status"],
+        by_location=stats["by_location"],
+        status_code=200
+    )
+
+
+# the maintained counters, or a database count when Redis has none
+def current_post_stats():
+    return post_stats.get() or PostStats.summarize(PostStats.count_rows(count_posts()))
+
+
+# the load of this replica, with the post total when stats are at hand
+def load_response(stats):
+    return animal_posts_pb2.LoadResponse(
+        load=rpc_in_flight.value,
+        status_code=200,
+        total_posts=stats["total"] if stats else 0,
+        in_flight=rpc_in_flight.value,
+        queue_depth=worker_pool._work_queue.qsize()
+    )
+
+
+# time a load probe may spend counting posts; unlike run_with_timeout, running out of it
+# leaves the call status alone, so the load is still reported
+def load_count_timeout(context, timeout=5):
+    remaining = context.time_remaining()
+    return timeout if remaining is None else min(timeout, remaining)
+
+
+def stream_chunk_size(request):
+    chunk_size = app.config['ANIMALS_STREAM_CHUNK_SIZE']
+    if request.chunk_size > 0:
+        chunk_size = min(request.chunk_size, chunk_size)
+    return chunk_size
+
+
+# mark a post as adopted in one conditional UPDATE, returning the row only if this call won
+def adopt_statement(post_id):
+    return (
+        animal_posts.update()
+        .where(animal_posts.c.id == post_id, animal_posts.c.status == "available")
+        .values(status="unavailable", version=animal_posts.c.version + 1)
+        .returning(*animal_posts.c)
+    )
+
+
+# adopt prepared posts in one UPDATE, returning only those still at the version Prepare read
+def adopt_prepared_statement(versions):
+    return (
+        animal_posts.update()
+        .where(
+            tuple_(animal_posts.c.id, animal_posts.c.version).in_(list(versions.items())),
+            animal_posts.c.status == "available"
+        )
+        .values(status="unavailable", version=animal_posts.c.version + 1)
+        .returning(*animal_posts.c)
+    )
+
+
+# ids in a JSON payload may be sent as strings, e.g. {"postId": "5"}
+def parse_post_id(value):
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"Invalid post id: {value!r}")
+    return int(value)
+
+
+def to_animal_post(post):
+    return animal_posts_pb2.AnimalPost(
+        postId=post.id,
+        title=post.title,
+        description=post.description,
+        location=post.location,
+        status=post.status
+    )
+
+
 class AnimalService(animal_posts_pb2_grpc.AnimalPostServiceServicer):
-    # run tasks with a timeout
-    def run_with_timeout(self, task_func, timeout, *args, **kwargs):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(task_func, *args, **kwargs)
+    # run tasks on the shared worker pool, bounded by the RPC deadline
+    def run_with_timeout(self, task_func, timeout, context):
+        # on a worker thread the grpc.aio front end has already counted the call
+        if getattr(request_deadline, "worker", False):
+            return self._run_with_timeout(task_func, timeout, context)
+        with rpc_in_flight.track():
+            return self._run_with_timeout(task_func, timeout, context)
+
+    def _run_with_timeout(self, task_func, timeout, context):
+        remaining = context.time_remaining()
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        deadline = time.monotonic() + timeout
+
+        def task():
+            with deadline_scope(deadline):
+                return task_func()
+
+        if timeout <= 0:
+            return self.timed_out(context, timeout)
+
+        try:
+            # the grpc.aio server already calls handlers on a pool worker, run the task inline there
+            if getattr(request_deadline, "worker", False):
+                return task()
+
+            future = worker_pool.submit(task)
             try:
                 return future.result(timeout=timeout)
             except concurrent.futures.TimeoutError as e:
-                print("Request timed out")
-                return animal_posts_pb2.CreateAnimalResponse(postId=0, message="Request timed out after 5 seconds", status_code=408)
-            except Exception as e:
-                print(f"An error occurred: {e}")
-                return animal_posts_pb2.CreateAnimalResponse(postId=0, message=f"An error occurred: {e}", status_code=500)
+                # a queued task never starts, a running one is stopped by the statement timeout
+                future.cancel()
+                return self.timed_out(context, timeout)
+        except TimeoutError:
+            # the task gave up on its own once the deadline passed
+            return self.timed_out(context, timeout)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            return animal_posts_pb2.CreateAnimalResponse(postId=0, message=f"An error occurred: {e}", status_code=500)
+
+    def timed_out(self, context, timeout):
+        print("Request timed out")
+        context.set_details('Request timed out')
+        context.set_code(grpc.StatusCode.DEADLINE_EXCEEDED)
+        return animal_posts_pb2.CreateAnimalResponse(postId=0, message=f"Request timed out after {max(timeout, 0):g} seconds", status_code=408)
 
 
     # create a new animal post
@@ -69,23 +404,64 @@ class AnimalService(animal_posts_pb2_grpc.AnimalPostServiceServicer):
                 "status": request.status
             }
 
-            with app.app_context():
-                db.session.execute(animal_posts.insert().values(new_post))
+            with db_session() as session:
+                post_id = session.execute(animal_posts.insert().values(new_post).returning(animal_posts.c.id)).fetchone()[0]
                 #time.sleep(10)
-                db.session.commit()
-                post_id = db.session.execute(animal_posts.select().order_by(animal_posts.c.id.desc())).fetchone()[0]
+                session.commit()
 
-            redis_client.set("animals", '')
+            created = animal_posts_pb2.AnimalPost(postId=post_id, **new_post)
+            animal_cache.post_created(created)
+            post_stats.record(added=[created])
             return animal_posts_pb2.CreateAnimalResponse(postId=post_id, message="Post created successfully", status_code=200)
 
-        return self.run_with_timeout(create_task, 5)
+        return self.run_with_timeout(create_task, 5, context)
+
+
+    # create many animal posts in one multi-row INSERT ... RETURNING
+    def CreateAnimalPosts(self, request, context):
+        def create_many_task():
+            if len(request.posts) > app.config['ANIMALS_MAX_BATCH_SIZE']:
+                context.set_details(f"At most {app.config['ANIMALS_MAX_BATCH_SIZE']} posts can be created at once")
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                return animal_posts_pb2.CreateAnimalPostsResponse(message="Too many posts", status_code=400)
+
+            new_posts = [
+                {
+                    "title": post.title,
+                    "description": post.description,
+                    "location": post.location,
+                    "status": post.status
+                }
+                for post in request.posts
+            ]
+            if not new_posts:
+                return animal_posts_pb2.CreateAnimalPostsResponse(message="No posts to create", status_code=200)
+
+            # executemany with RETURNING is sent as batched multi-row VALUES, ids come back in input order
+            with db_session() as session:
+                insert = animal_posts.insert().returning(animal_posts.c.id, sort_by_parameter_order=True)
+                post_ids = session.execute(insert, new_posts).scalars().all()
+                session.commit()
+
+            created = [
+                animal_posts_pb2.AnimalPost(postId=post_id, **new_post) for post_id, new_post in zip(post_ids, new_posts)
+            ]
+            animal_cache.posts_created(created)
+            post_stats.record(added=created)
+            return animal_posts_pb2.CreateAnimalPostsResponse(
+                postIds=post_ids,
+                message=f"{len(post_ids)} posts created successfully",
+                status_code=200
+            )
+
+        return self.run_with_timeout(create_many_task, 30, context)
 
 
     # update an existing animal post
     def UpdateAnimalPost(self, request, context):
         def update_task():
-            with app.app_context():
-                post = db.session.execute(animal_posts.select().where(animal_posts.c.id == request.postId)).fetchone()
+            with db_session() as session:
+                post = session.execute(animal_posts.select().where(animal_posts.c.id == request.postId)).fetchone()
                 if post is None:
                     context.set_details('Post not found')
                     context.set_code(grpc.StatusCode.NOT_FOUND)
@@ -97,65 +473,131 @@ class AnimalService(animal_posts_pb2_grpc.AnimalPostServiceServicer):
                     "location": request.location,
                     "status": request.status
                 }
-                db.session.execute(animal_posts.update().where(animal_posts.c.id == request.postId).values(updated_post))
-                db.session.commit()
+                session.execute(
+                    animal_posts.update()
+                    .where(animal_posts.c.id == request.postId)
+                    .values(updated_post, version=animal_posts.c.version + 1)
+                )
+                session.commit()
 
-            redis_client.set("animals", '')
+            old, new = to_animal_post(post), animal_posts_pb2.AnimalPost(postId=request.postId, **updated_post)
+            animal_cache.post_updated(old, new)
+            post_stats.record(added=[new], removed=[old])
             return animal_posts_pb2.UpdateAnimalResponse(message="Post updated successfully", status_code=200)
 
-        return self.run_with_timeout(update_task, 5)
+        return self.run_with_timeout(update_task, 5, context)
 
 
     # retrieve animal posts
     def GetAnimals(self, request, context):
         def get_animals_task():
-            if animals := redis_client.get("animals"):
-                return animal_posts_pb2.AnimalListResponse(posts=map(animal_posts_pb2.AnimalPost, json.loads(animals)), source="Redis")
-
-            with app.app_context():
-                posts = db.session.execute(animal_posts.select()).fetchall()
-            animals = []
-            animals_data = []
-            for post in posts:
-                animal = animal_posts_pb2.AnimalPost(
-                    postId=post.id,
-                    title=post.title,
-                    description=post.description,
-                    location=post.location,
-                    status=post.status
+            def load_animals():
+                with db_session() as session:
+                    posts = session.execute(animal_posts.select()).fetchall()
+                return [to_animal_post(post) for post in posts], ""
+
+            def build_response():
+                animals, _, source = animal_cache.get_or_load_page(
+                    animal_cache.page_key(), load_animals, deadline=getattr(request_deadline, "value", None)
+                )
+                return animal_posts_pb2.AnimalListResponse(posts=animals, source=source)
+
+            return serve_locally_cached(("animals",), animal_posts_pb2.AnimalListResponse, ["all"], build_response)
+
+        return self.run_with_timeout(get_animals_task, 5, context)
+
+
+    # retrieve one page of animal posts, keyset-paginated on id
+    def GetAnimalsPage(self, request, context):
+        def get_page_task():
+            page_size = request.page_size or app.config['ANIMALS_PAGE_SIZE']
+            page_size = max(1, min(page_size, app.config['ANIMALS_MAX_PAGE_SIZE']))
+            try:
+                after_id = decode_cursor(request.cursor)
+            except ValueError:
+                context.set_details('Invalid cursor')
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                return animal_posts_pb2.AnimalPageResponse()
+
+            def load_page():
+                # fetch one extra row to know whether another page exists
+                query = filter_posts(animal_posts.select().where(animal_posts.c.id > after_id), request)
+                with db_session() as session:
+                    posts = session.execute(query.order_by(animal_posts.c.id).limit(page_size + 1)).fetchall()
+
+                next_cursor = encode_cursor(posts[page_size - 1].id) if len(posts) > page_size else ""
+                return [to_animal_post(post) for post in posts[:page_size]], next_cursor
+
+            def build_response():
+                cache_key = animal_cache.page_key(request.status, request.location, request.cursor, page_size)
+                animals, next_cursor, source = animal_cache.get_or_load_page(
+                    cache_key, load_page, deadline=getattr(request_deadline, "value", None)
                 )
-                animals.append(animal)
-                animals_data.append(dict(
-                    postId=post.id,
-                    title=post.title,
-                    description=post.description,
-                    location=post.location,
-                    status=post.status
-                ))
+                return animal_posts_pb2.AnimalPageResponse(posts=animals, next_cursor=next_cursor, source=source)
+
+            query = ("page", request.status, request.location, request.cursor, page_size)
+            scopes = animal_cache.query_scopes(request.status, request.location)
+            return serve_locally_cached(query, animal_posts_pb2.AnimalPageResponse, scopes, build_response)
+
+        return self.run_with_timeout(get_page_task, 5, context)
 
-            redis_client.set("animals", json.dumps(animals_data))
-            return animal_posts_pb2.AnimalListResponse(posts=animals, source="Database")
 
-        return self.run_with_timeout(get_animals_task, 5)
+    # ranked full-text search over title and description, optionally narrowed by location
+    def SearchAnimals(self, request, context):
+        def search_task():
+            window = search_window(request, context)
+            if window is None:
+                return animal_posts_pb2.AnimalPageResponse()
+            offset, limit = window
+            if limit <= 0:
+                return animal_posts_pb2.AnimalPageResponse(source="Database")
+
+            with db_session() as session:
+                posts = session.execute(search_posts(request).offset(offset).limit(limit + 1)).fetchall()
+            return search_page(posts, offset, limit)
+
+        return self.run_with_timeout(search_task, 5, context)
+
+    # stream animal posts as they are fetched from a server-side cursor
+    def ListAnimals(self, request, context):
+        chunk_size = stream_chunk_size(request)
+        remaining = context.time_remaining()
+        deadline = time.monotonic() + remaining if remaining is not None else None
+
+        query = filter_posts(animal_posts.select(), request).order_by(animal_posts.c.id)
+        with deadline_scope(deadline), db_session() as session:
+            # yield_per switches psycopg2 to a named cursor, so only one chunk is held in memory
+            result = session.execute(query.execution_options(yield_per=chunk_size))
+            try:
+                for posts in result.partitions():
+                    # stop reading once the client has gone away or its deadline expired
+                    if not context.is_active():
+                        return
+                    for post in posts:
+                        yield to_animal_post(post)
+            finally:
+                result.close()
 
 
     # delete animal post
     def DeleteAnimalPost(self, request, context):
         def delete_task():
-            with app.app_context():
-                post = db.session.execute(animal_posts.select().where(animal_posts.c.id == request.postId)).fetchone()
+            with db_session() as session:
+                post = session.execute(animal_posts.select().where(animal_posts.c.id == request.postId)).fetchone()
                 if post is None:
                     context.set_details('Post not found')
                     context.set_code(grpc.StatusCode.NOT_FOUND)
                     return animal_posts_pb2.DeleteAnimalResponse(message="Post not found", status_code=404)
 
-                db.session.execute(animal_posts.delete().where(animal_posts.c.id == request.postId))
-                db.session.commit()
+                session.execute(animal_posts.delete().where(animal_posts.c.id == request.postId))
+                session.commit()
 
-            redis_client.set("animals", None)
+            deleted = to_animal_post(post)
+            animal_cache.post_deleted(deleted)
+            post_stats.record(removed=[deleted])
             return animal_posts_pb2.DeleteAnimalResponse(message="Post deleted successfully", status_code=200)
 
-        return self.run_with_timeout(delete_task, 5)
+        return self.run_with_timeout(delete_task, 5, context)
 
 
     # check the status of the service
@@ -163,74 +605,131 @@ class AnimalService(animal_posts_pb2_grpc.AnimalPostServiceServicer):
         def status_task():
             return animal_posts_pb2.StatusResponse(status="Service is running", status_code=200)
 
-        return self.run_with_timeout(status_task, 5)
+        return self.run_with_timeout(status_task, 5, context)
 
     
     def AdoptAnimal(self, request, context):
-        def _():
-            post = db.session.execute(animal_posts.select().where(animal_posts.c.id == request.postId, animal_posts.c.status == "available")).fetchone()
-            if post is None:
+        def adopt_task():
+            with db_session() as session:
+                post = session.execute(adopt_statement(request.postId)).fetchone()
+                # only a failed adoption pays for telling a missing post from an unavailable one
+                exists = post is not None or session.execute(
+                    select(animal_posts.c.id).where(animal_posts.c.id == request.postId)
+                ).fetchone() is not None
+                session.commit()
+
+            if not exists:
                 context.set_details('Post not found')
                 context.set_code(grpc.StatusCode.NOT_FOUND)
-                return animal_posts_pb2.DeleteAnimalResponse(message="Post not found", status_code=404)
-            
-            db.session.execute(animal_posts.update().where(animal_posts.c.id == request.postId).values({"status": "unavailable"}))
-            db.session.commit()
+                return animal_posts_pb2.AdoptAnimalResponse(status="Post not found", status_code=404)
 
+            # another request adopted the animal first, or it was never up for adoption
+            if post is None:
+                context.set_details('Animal is not available for adoption')
+                context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+                return animal_posts_pb2.AdoptAnimalResponse(status="Animal already adopted", status_code=409)
+
+            old, adopted = animal_posts_pb2.AnimalPost(postId=post.id, status="available", location=post.location), to_animal_post(post)
+            animal_cache.post_updated(old, adopted)
+            post_stats.record(added=[adopted], removed=[old])
             return animal_posts_pb2.AdoptAnimalResponse(status="Animal adopted", status_code=200)
 
-        return self.run_with_timeout(_, 5)
+        return self.run_with_timeout(adopt_task, 5, context)
 
     
-    # get load method implementation
+    # report request pressure; answered inline so the probe never waits in the queue it measures
     def GetLoad(self, request, context):
-        def load_task():
-            with app.app_context():
-                total_posts = db.session.query(animal_posts).count()
-            return animal_posts_pb2.LoadResponse(load=total_posts, status_code=200)
+        return load_response(post_stats.get() or self.counted_post_stats(context))
+
+    # the database count for GetLoad, or None when it fails or runs out of time
+    def counted_post_stats(self, context):
+        timeout = load_count_timeout(context)
+        if timeout <= 0:
+            return None
+        deadline = time.monotonic() + timeout
+
+        def task():
+            with deadline_scope(deadline):
+                return current_post_stats()
+
+        future = worker_pool.submit(task)
+        try:
+            return future.result(timeout=timeout)
+        except Exception as e:
+            future.cancel()
+            print(f"Failed to count posts for the load report: {e!r}")
+            return None
 
-        return self.run_with_timeout(load_task, 5)
+    # post counts by status and location, read from the counters maintained on every write
+    def GetStats(self, request, context):
+        def stats_task():
+            return to_stats_response(current_post_stats())
 
-    transaction_store = {}
+        return self.run_with_timeout(stats_task, 5, context)
 
     def Prepare(self, request, context):
+        locked_post_ids = []
         try:
-            payload = json.loads(request.payload)
-            post_id = payload.get("postId")
+            payload = json.loads(request.payload) if request.payload else {}
+            # a batch names its posts in post_ids, a single-post transaction in the payload
+            try:
+                post_ids = list(dict.fromkeys(request.post_ids)) or [parse_post_id(payload.get("postId"))]
+            except ValueError as e:
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                return animal_posts_pb2.TransactionResponse(
+                    transaction_id=request.transaction_id,
+                    success=False,
+                    message=str(e)
+                )
             operation = request.operation
 
-            # Check if the resource is already locked
-            lock_key = f"lock:post:{post_id}"
-            if redis_client.get(lock_key):
+            if len(post_ids) > app.config['ANIMALS_MAX_BATCH_SIZE']:
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                return animal_posts_pb2.TransactionResponse(
+                    transaction_id=request.transaction_id,
+                    success=False,
+                    message=f"At most {app.config['ANIMALS_MAX_BATCH_SIZE']} posts per transaction."
+                )
+
+            # Lock every post for this transaction at once, unless another one holds any of them
+            if not transaction_store.lock(request.transaction_id, post_ids):
                 context.set_code(grpc.StatusCode.ABORTED)
                 return animal_posts_pb2.TransactionResponse(
                     transaction_id=request.transaction_id,
                     success=False,
                     message="Resource is locked for another transaction."
                 )
+            locked_post_ids = post_ids
+
+            with db_session() as session:
+                posts = session.execute(
+                    select(animal_posts.c.id, animal_posts.c.status, animal_posts.c.version)
+                    .where(animal_posts.c.id.in_(post_ids))
+                ).fetchall()
+
+            available = {post.id for post in posts if post.status == "available"}
+            unavailable = [post_id for post_id in post_ids if post_id not in available]
+            if operation == "adopt" and unavailable:
+                transaction_store.unlock(request.transaction_id, post_ids)
+                context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+                return animal_posts_pb2.TransactionResponse(
+                    transaction_id=request.transaction_id,
+                    success=False,
+                    message=f"Posts {unavailable} are not available for adoption."
+                )
 
-            # Lock the resource for this transaction
-            redis_client.set(lock_key, "locked", ex=60)  # Lock expires in 60 seconds
-
-            with app.app_context():
-                post = db.session.execute(
-                    animal_posts.select().where(animal_posts.c.id == post_id)
-                ).fetchone()
-                if operation == "adopt" and (not post or post.status != "available"):
-                    context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
-                    return animal_posts_pb2.TransactionResponse(
-                        transaction_id=request.transaction_id,
-                        success=False,
-                        message=f"Post {post_id} is not available for adoption."
-                    )
-
-            self.transaction_store[request.transaction_id] = {"state": "prepared", "payload": payload}
+            # remember the row versions so Commit can tell whether a post changed in between
+            versions = {post.id: post.version for post in posts}
+            transaction_store.prepare(request.transaction_id, payload, post_ids, versions)
             return animal_posts_pb2.TransactionResponse(
                 transaction_id=request.transaction_id,
                 success=True,
                 message="Prepare phase successful."
             )
         except Exception as e:
+            # the posts would otherwise stay locked until the locks expire
+            with contextlib.suppress(Exception):
+                transaction_store.unlock(request.transaction_id, locked_post_ids)
             context.set_code(grpc.StatusCode.INTERNAL)
             return animal_posts_pb2.TransactionResponse(
                 transaction_id=request.transaction_id,
@@ -243,32 +742,45 @@ class AnimalService(animal_posts_pb2_grpc.AnimalPostServiceServicer):
         """
         Commit phase: Finalize the transaction.
         """
+        claimed = written = False
         try:
-            transaction = self.transaction_store.get(request.transaction_id)
-            if not transaction or transaction["state"] != "prepared":
-                context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
-                return animal_posts_pb2.TransactionResponse(
-                    transaction_id=request.transaction_id,
-                    success=False,
-                    message="Transaction not in prepared state."
-                )
-
-            payload = transaction["payload"]
-            post_id = payload.get("postId")
+            # a duplicate Commit reaching another replica must not act on the transaction too
+            state = transaction_store.claim(request.transaction_id, "prepared", "committing")
+            if state != "prepared":
+                return self.commit_outcome(request.transaction_id, state, context)
+            claimed = True
+            transaction = transaction_store.get(request.transaction_id)
+
+            versions = transaction["versions"]
             operation = request.operation
 
-            # Finalize the transaction (e.g., mark the animal as adopted)
-            with app.app_context():
-                if operation == "adopt":
-                    db.session.execute(
-                        animal_posts.update()
-                        .where(animal_posts.c.id == post_id)
-                        .values({"status": "unavailable"})
-                    )
-                    db.session.commit()
-
-            # Mark the transaction as committed
-            self.transaction_store[request.transaction_id]["state"] = "committed"
+            # Finalize the transaction (e.g., mark the animals as adopted) in one DB transaction
+            if operation == "adopt":
+                with db_session() as session:
+                    posts = session.execute(adopt_prepared_statement(versions)).fetchall()
+                    # all posts are adopted or none of them
+                    if len(posts) != len(versions):
+                        session.rollback()
+                        transaction_store.finish(request.transaction_id, transaction, "aborted")
+                        context.set_code(grpc.StatusCode.ABORTED)
+                        return animal_posts_pb2.TransactionResponse(
+                            transaction_id=request.transaction_id,
+                            success=False,
+                            message="Some posts were adopted or changed after the prepare phase."
+                        )
+                    session.commit()
+                    written = True
+
+                changes = [
+                    (animal_posts_pb2.AnimalPost(postId=post.id, status="available", location=post.location),
+                     to_animal_post(post))
+                    for post in posts
+                ]
+                animal_cache.posts_updated(changes)
+                post_stats.record(added=[new for old, new in changes], removed=[old for old, new in changes])
+
+            # Mark the transaction as committed and release its locks
+            transaction_store.finish(request.transaction_id, transaction, "committed")
             return animal_posts_pb2.TransactionResponse(
                 transaction_id=request.transaction_id,
                 success=True,
@@ -276,6 +788,10 @@ class AnimalService(animal_posts_pb2_grpc.AnimalPostServiceServicer):
             )
 
         except Exception as e:
+            if claimed and not written:
+                # nothing was committed, let a retry claim the transaction again
+                with contextlib.suppress(Exception):
+                    transaction_store.claim(request.transaction_id, "committing", "prepared")
             context.set_code(grpc.StatusCode.INTERNAL)
             return animal_posts_pb2.TransactionResponse(
                 transaction_id=request.transaction_id,
@@ -283,10 +799,41 @@ class AnimalService(animal_posts_pb2_grpc.AnimalPostServiceServicer):
                 message=f"Commit phase failed: {str(e)}"
             )
 
+    # answer a Commit that found the transaction already claimed with what became of it
+    def commit_outcome(self, transaction_id, state, context):
+        if state == "committed":
+            return animal_posts_pb2.TransactionResponse(
+                transaction_id=transaction_id,
+                success=True,
+                message="Commit phase successful."
+            )
+        if state == "aborted":
+            context.set_code(grpc.StatusCode.ABORTED)
+            return animal_posts_pb2.TransactionResponse(
+                transaction_id=transaction_id,
+                success=False,
+                message="Some posts were adopted or changed after the prepare phase."
+            )
+        if state == "committing":
+            context.set_code(grpc.StatusCode.UNAVAILABLE)
+            return animal_posts_pb2.TransactionResponse(
+                transaction_id=transaction_id,
+                success=False,
+                message="Commit is in progress, retry later."
+            )
+        context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+        return animal_posts_pb2.TransactionResponse(
+            transaction_id=transaction_id,
+            success=False,
+            message="Transaction not in prepared state."
+        )
+
     def Rollback(self, request, context):
         try:
-            transaction = self.transaction_store.get(request.transaction_id)
-            if not transaction or transaction["state"] != "prepared":
+            # claimed like a Commit, so a rollback racing one can not overwrite its outcome
+            state = transaction_store.claim(request.transaction_id, "prepared", "rolled_back")
+            transaction = transaction_store.get(request.transaction_id) if state == "prepared" else None
+            if not transaction:
                 context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
                 return animal_posts_pb2.TransactionResponse(
                     transaction_id=request.transaction_id,
@@ -294,15 +841,8 @@ class AnimalService(animal_posts_pb2_grpc.AnimalPostServiceServicer):
                     message="Transaction not in prepared state or already committed."
                 )
 
-            payload = transaction["payload"]
-            post_id = payload.get("postId")
-            lock_key = f"lock:post:{post_id}"
-
-            # Release the lock
-            redis_client.delete(lock_key)
-
-            # Mark the transaction as rolled back
-            self.transaction_store[request.transaction_id]["state"] = "rolled_back"
+            # Mark the transaction as rolled back and release its locks
+            transaction_store.finish(request.transaction_id, transaction, "rolled_back")
             return animal_posts_pb2.TransactionResponse(
                 transaction_id=request.transaction_id,
                 success=True,
@@ -317,10 +857,141 @@ class AnimalService(animal_posts_pb2_grpc.AnimalPostServiceServicer):
             )
 
 
+# grpc.aio front end: reads run natively on the loop, the rest of AnimalService on the worker pool
+class AsyncAnimalService:
+    def __init__(self, service, async_engine, async_redis=None):
+        self.service = service
+        self.async_engine = async_engine
+        self.async_redis = async_redis
+
+    def __getattr__(self, name):
+        handler = getattr(self.service, name)
+
+        async def run_on_worker_pool(request, context):
+            loop = asyncio.get_running_loop()
+            with rpc_in_flight.track():
+                return await loop.run_in_executor(worker_pool, handler, request, context)
+
+        return run_on_worker_pool
+
+    # run a coroutine bounded by the RPC deadline; cancelling it cancels the running query
+    async def run_with_timeout(self, coro_func, timeout, context):
+        remaining = context.time_remaining()
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        if timeout <= 0:
+            return self.service.timed_out(context, timeout)
+
+        with rpc_in_flight.track():
+            try:
+                return await asyncio.wait_for(coro_func(), timeout)
+            except asyncio.TimeoutError:
+                return self.service.timed_out(context, timeout)
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                return animal_posts_pb2.CreateAnimalResponse(postId=0, message=f"An error occurred: {e}", status_code=500)
+
+    # the counters maintained in Redis, or None when they are missing or unreachable
+    async def post_counters(self):
+        if self.async_redis is None:
+            return None
+        try:
+            return PostStats.parse(await self.async_redis.hgetall(PostStats.key))
+        except redis.RedisError as e:
+            print(f"Failed to read post counters: {e}")
+            return None
+
+    async def current_post_stats(self):
+        if stats := await self.post_counters():
+            return stats
+        async with self.async_engine.connect() as conn:
+            rows = (await conn.execute(post_counts_query())).fetchall()
+        return PostStats.summarize(PostStats.count_rows(rows))
+
+    async def SearchAnimals(self, request, context):
+        window = search_window(request, context)
+        if window is None:
+            return animal_posts_pb2.AnimalPageResponse()
+        offset, limit = window
+        if limit <= 0:
+            return animal_posts_pb2.AnimalPageResponse(source="Database")
+
+        async def search():
+            async with self.async_engine.connect() as conn:
+                posts = (await conn.execute(search_posts(request).offset(offset).limit(limit + 1))).fetchall()
+            return search_page(posts, offset, limit)
+
+        return await self.run_with_timeout(search, 5, context)
+
+    # answered on the event loop, the worker pool may be the queue this probe measures
+    async def GetLoad(self, request, context):
+        try:
+            stats = await asyncio.wait_for(self.current_post_stats(), load_count_timeout(context))
+        except Exception as e:
+            print(f"Failed to count posts for the load report: {e!r}")
+            stats = None
+        return load_response(stats)
+
+    async def GetStats(self, request, context):
+        async def stats():
+            return to_stats_response(await self.current_post_stats())
+
+        return await self.run_with_timeout(stats, 5, context)
+
+    async def ListAnimals(self, request, context):
+        query = filter_posts(animal_posts.select(), request).order_by(animal_posts.c.id)
+        # a cancelled call cancels the coroutine, which cancels the running query
+        async with self.async_engine.connect() as conn:
+            result = await conn.stream(query.execution_options(yield_per=stream_chunk_size(request)))
+            async for posts in result.partitions():
+                for post in posts:
+                    yield to_animal_post(post)
+
+
+def grpc_server_options():
+    return [
+        ('grpc.keepalive_time_ms', app.config['GRPC_KEEPALIVE_TIME_MS']),
+        ('grpc.keepalive_timeout_ms', app.config['GRPC_KEEPALIVE_TIMEOUT_MS']),
+        ('grpc.keepalive_permit_without_calls', 1),
+        ('grpc.http2.min_ping_interval_without_data_ms', app.config['GRPC_KEEPALIVE_TIME_MS']),
+        ('grpc.max_send_message_length', app.config['GRPC_MAX_MESSAGE_LENGTH']),
+        ('grpc.max_receive_message_length', app.config['GRPC_MAX_MESSAGE_LENGTH'])
+    ]
+
+
+async def serve_aio():
+    server = grpc.aio.server(
+        options=grpc_server_options(),
+        maximum_concurrent_rpcs=app.config['GRPC_MAXIMUM_CONCURRENT_RPCS'] or None
+    )
+    async_engine = create_async_engine(app.config['ASYNC_DATABASE_URI'], **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    async_redis = redis.asyncio.Redis(host='redis', port=6379) if redis_client is not None else None
+    animal_posts_pb2_grpc.add_AnimalPostServiceServicer_to_server(
+        AsyncAnimalService(AnimalService(), async_engine, async_redis), server
+    )
+    server.add_insecure_port('[::]:50052')
+    print("gRPC server (asyncio) is running on port 50052")
+    await server.start()
+    try:
+        await server.wait_for_termination()
+    finally:
+        await async_engine.dispose()
+        if async_redis is not None:
+            await async_redis.aclose()
+
+
 # start the gRPC server
 def start_grpc_server():
     """Start the gRPC server."""
-    server = grpc.server(concurrent.futures.ThreadPoolExecutor(max_workers=3))
+    if app.config['GRPC_SERVER_MODE'] == 'aio':
+        asyncio.run(serve_aio())
+        return
+
+    server = grpc.server(
+        concurrent.futures.ThreadPoolExecutor(max_workers=app.config['GRPC_MAX_WORKERS']),
+        options=grpc_server_options(),
+        maximum_concurrent_rpcs=app.config['GRPC_MAXIMUM_CONCURRENT_RPCS'] or None
+    )
     animal_posts_pb2_grpc.add_AnimalPostServiceServicer_to_server(AnimalService(), server)
     server.add_insecure_port('[::]:50052')
     print("gRPC server is running on port 50052")
@@ -331,6 +1002,12 @@ def start_grpc_server():
 if __name__ == '__main__':
     # Register the service in a service discovery mechanism
     register_service("AnimalService", "animal_posts_service:50052")
+
+    # keep the in-process cache coherent with writes made on other replicas
+    animal_cache.listen_for_invalidations()
+
+    # repair counter drift, e.g. from writes made while Redis was unreachable
+    post_stats.reconcile(count_posts())
     
     # Run the gRPC server in a separate thread
     grpc_thread = threading.Thread(target=start_grpc_server, daemon=True)
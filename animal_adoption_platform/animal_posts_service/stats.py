@@ -0,0 +1,84 @@
+#animal_posts_service/stats.py
+import collections
+import redis
+
+
+# post counters (total, per status, per location) kept in one Redis hash
+class PostStats:
+    key = "animals:stats"
+
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def fields(post):
+        return ["total", f"status:{post.status}", f"location:{post.location}"]
+
+    # count (status, location, count) rows into counter fields
+    @staticmethod
+    def count_rows(rows):
+        counts = collections.Counter()
+        for status, location, count in rows:
+            counts["total"] += count
+            counts[f"status:{status}"] += count
+            counts[f"location:{location}"] += count
+        return counts
+
+    # turn counter fields into {"total": n, "by_status": {...}, "by_location": {...}}
+    @staticmethod
+    def summarize(counts):
+        stats = {"total": counts.get("total", 0), "by_status": {}, "by_location": {}}
+        for field, count in counts.items():
+            kind, _, value = field.partition(":")
+            if kind in ("status", "location") and count > 0:
+                stats[f"by_{kind}"][value] = count
+        return stats
+
+    # adjust the counters for posts that entered and left the table (an update does both)
+    def record(self, added=(), removed=()):
+        deltas = collections.Counter()
+        for post in added:
+            for field in self.fields(post):
+                deltas[field] += 1
+        for post in removed:
+            for field in self.fields(post):
+                deltas[field] -= 1
+        deltas = {field: delta for field, delta in deltas.items() if delta}
+        if self.client is None or not deltas:
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for field, delta in deltas.items():
+                pipe.hincrby(self.key, field, delta)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Failed to update post counters: {e}")
+
+    def get(self):
+        if self.client is None:
+            return None
+        try:
+            counts = self.client.hgetall(self.key)
+        except redis.RedisError as e:
+            print(f"Failed to read post counters: {e}")
+            return None
+        return self.parse(counts)
+
+    # summarize the raw HGETALL reply of the counters, None when the hash is missing
+    @classmethod
+    def parse(cls, counts):
+        if not counts:
+            return None
+        return cls.summarize({field.decode(): int(count) for field, count in counts.items()})
+
+    def reconcile(self, rows):
+        if self.client is None:
+            return
+        counts = self.count_rows(rows)
+        try:
+            pipe = self.client.pipeline()
+            pipe.delete(self.key)
+            pipe.hset(self.key, mapping={"total": 0, **counts})
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Failed to reconcile post counters: {e}")
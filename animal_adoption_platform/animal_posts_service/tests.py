@@ -1,9 +1,18 @@
+import asyncio
+import threading
+import time
 import unittest
-from unittest.mock import patch, MagicMock
+import grpc
+from unittest.mock import patch, MagicMock, AsyncMock
 import animal_posts_pb2
 import animal_posts_pb2_grpc
-from server import AnimalService
-from models import db, animal_posts
+from server import AnimalService, AsyncAnimalService, encode_cursor, decode_cursor
+from cache import AnimalCache, LocalCache, SingleFlight, encode_message, decode_message
+from transactions import TransactionStore
+from stats import PostStats
+from models import db, animal_posts, upgrade_schema
+from sqlalchemy.dialects import postgresql
+import fakeredis
 
 
 class TestAnimalService(unittest.TestCase):
@@ -11,10 +20,14 @@ class TestAnimalService(unittest.TestCase):
     def setUp(self):
         self.server = AnimalService()
         self.context = MagicMock()
+        self.context.time_remaining.return_value = None
 
-    #mock the database
-    @patch('server.db')
-    def test_create_animal_post(self, mock_db):
+        #mock the database session
+        db_session_patcher = patch('server.db_session')
+        self.session = db_session_patcher.start().return_value.__enter__.return_value
+        self.addCleanup(db_session_patcher.stop)
+
+    def test_create_animal_post(self):
         #using the new data provided
         request = animal_posts_pb2.CreateAnimalRequest(
             title="Cat",
@@ -25,15 +38,26 @@ class TestAnimalService(unittest.TestCase):
         )
 
         #mock database behavior
-        mock_db.session.execute.return_value = MagicMock()
-        mock_db.session.commit.return_value = None
-        mock_db.session.execute.return_value.fetchone.return_value = [1]
+        self.session.execute.return_value = MagicMock()
+        self.session.commit.return_value = None
+        self.session.execute.return_value.fetchone.return_value = [1]
         response = self.server.CreateAnimalPost(request, self.context)
         self.assertEqual(response.postId, 1)
         self.assertEqual(response.message, "Post created successfully")
 
-    @patch('server.db')
-    def test_update_animal_post(self, mock_db):
+    def test_create_animal_posts(self):
+        request = animal_posts_pb2.CreateAnimalPostsRequest(posts=[
+            animal_posts_pb2.CreateAnimalRequest(title="Cat", description="A lost cat", location="Park", status="available"),
+            animal_posts_pb2.CreateAnimalRequest(title="Dog", description="A lost dog", location="Park", status="available")
+        ])
+
+        self.session.execute.return_value.scalars.return_value.all.return_value = [7, 8]
+        response = self.server.CreateAnimalPosts(request, self.context)
+        self.assertEqual(list(response.postIds), [7, 8])
+        self.assertEqual(self.session.execute.call_count, 1)
+        self.assertEqual(len(self.session.execute.call_args.args[1]), 2)
+
+    def test_update_animal_post(self):
         request = animal_posts_pb2.UpdateAnimalRequest(
             postId=1,
             title="Cat",
@@ -44,15 +68,14 @@ class TestAnimalService(unittest.TestCase):
         )
 
         # mock fetching post
-        mock_db.session.execute.return_value.fetchone.return_value = [1, "Dog", "A friendly dog", "Shelter",
-                                                                      "Available", "image1.png"]
+        self.session.execute.return_value.fetchone.return_value = [1, "Dog", "A friendly dog", "Shelter",
+                                                                   "Available", "image1.png"]
 
         response = self.server.UpdateAnimalPost(request, self.context)
         self.assertEqual(response.message, "Post updated successfully")
 
-    @patch('server.db')
-    def test_get_animals(self, mock_db):
-        mock_db.session.execute.return_value.fetchall.return_value = [
+    def test_get_animals(self):
+        self.session.execute.return_value.fetchall.return_value = [
             MagicMock(id=1, title="Dog", description="A friendly dog", location="Shelter", status="Available",
                       images="image1.png"),
             MagicMock(id=2, title="Cat", description="A friendly cat", location="Home", status="Adopted",
@@ -65,30 +88,593 @@ class TestAnimalService(unittest.TestCase):
         self.assertEqual(response.posts[0].title, "Dog")
         self.assertEqual(response.posts[1].title, "Cat")
 
-    @patch('server.db')
-    def test_delete_animal_post(self, mock_db):
+    @patch.object(AnimalCache, 'get_page', return_value=([animal_posts_pb2.AnimalPost(postId=1, title="Dog")], ""))
+    @patch.object(AnimalCache, 'page_key', return_value="animals:page:query:0")
+    def test_get_animals_from_cache(self, mock_page_key, mock_get_page):
+        response = self.server.GetAnimals(animal_posts_pb2.Empty(), self.context)
+        self.assertEqual(response.source, "Redis")
+        self.assertEqual(response.posts[0].title, "Dog")
+        self.session.execute.assert_not_called()
+
+    def test_get_animals_page(self):
+        self.session.execute.return_value.fetchall.return_value = [
+            MagicMock(id=3, title="Dog", description="A friendly dog", location="Shelter", status="available"),
+            MagicMock(id=5, title="Cat", description="A friendly cat", location="Shelter", status="available"),
+            MagicMock(id=8, title="Bird", description="A loud bird", location="Shelter", status="available")
+        ]
+
+        request = animal_posts_pb2.AnimalPageRequest(page_size=2, cursor=encode_cursor(2), status="available")
+        response = self.server.GetAnimalsPage(request, self.context)
+        self.assertEqual([post.postId for post in response.posts], [3, 5])
+        self.assertEqual(decode_cursor(response.next_cursor), 5)
+
+    def test_get_animals_page_invalid_cursor(self):
+        request = animal_posts_pb2.AnimalPageRequest(cursor="not-a-cursor")
+        response = self.server.GetAnimalsPage(request, self.context)
+        self.assertEqual(len(response.posts), 0)
+        self.context.set_code.assert_called_with(grpc.StatusCode.INVALID_ARGUMENT)
+        self.session.execute.assert_not_called()
+
+    def test_search_animals(self):
+        self.session.execute.return_value.fetchall.return_value = [
+            MagicMock(id=8, title="Black cat", description="A shy cat", location="Park", status="available"),
+            MagicMock(id=3, title="Cat", description="A friendly cat", location="Park", status="available"),
+            MagicMock(id=5, title="Cat and dog", description="Best friends", location="Home", status="available")
+        ]
+
+        request = animal_posts_pb2.SearchAnimalsRequest(query="cat", location="park", page_size=2)
+        response = self.server.SearchAnimals(request, self.context)
+        self.assertEqual([post.postId for post in response.posts], [8, 3])
+        self.assertEqual(decode_cursor(response.next_cursor), 2)
+
+        sql = str(self.session.execute.call_args.args[0].compile(dialect=postgresql.dialect()))
+        self.assertIn("websearch_to_tsquery", sql)
+        self.assertIn("ORDER BY rank DESC", sql)
+
+    def test_search_animals_requires_terms(self):
+        response = self.server.SearchAnimals(animal_posts_pb2.SearchAnimalsRequest(status="available"), self.context)
+        self.assertEqual(len(response.posts), 0)
+        self.context.set_code.assert_called_with(grpc.StatusCode.INVALID_ARGUMENT)
+        self.session.execute.assert_not_called()
+
+    def test_list_animals_streams_partitions(self):
+        self.session.execute.return_value.partitions.return_value = [
+            [MagicMock(id=1, title="Dog", description="A friendly dog", location="Shelter", status="available"),
+             MagicMock(id=2, title="Cat", description="A friendly cat", location="Home", status="available")],
+            [MagicMock(id=3, title="Bird", description="A loud bird", location="Home", status="available")]
+        ]
+        self.context.is_active.return_value = True
+
+        request = animal_posts_pb2.ListAnimalsRequest(chunk_size=2)
+        posts = list(self.server.ListAnimals(request, self.context))
+        self.assertEqual([post.title for post in posts], ["Dog", "Cat", "Bird"])
+        self.session.execute.return_value.close.assert_called_once()
+
+    def test_delete_animal_post(self):
         request = animal_posts_pb2.DeleteAnimalRequest(postId=1)
 
         # mock fetching post
-        mock_db.session.execute.return_value.fetchone.return_value = [1, "Dog", "A friendly dog", "Shelter",
-                                                                      "Available", "image1.png"]
+        self.session.execute.return_value.fetchone.return_value = [1, "Dog", "A friendly dog", "Shelter",
+                                                                   "Available", "image1.png"]
 
         response = self.server.DeleteAnimalPost(request, self.context)
         self.assertEqual(response.message, "Post deleted successfully")
 
-    @patch('server.db')
-    def test_check_status(self, mock_db):
+    def test_adopt_animal(self):
+        self.session.execute.return_value.fetchone.return_value = MagicMock(
+            id=1, title="Dog", description="A friendly dog", location="Shelter", status="unavailable")
+
+        response = self.server.AdoptAnimal(animal_posts_pb2.AdoptAnimalRequest(postId=1), self.context)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.session.execute.call_count, 1)
+
+    def test_adopt_animal_already_adopted(self):
+        # the conditional UPDATE matches nothing, but the post exists
+        self.session.execute.side_effect = [
+            MagicMock(fetchone=MagicMock(return_value=None)),
+            MagicMock(fetchone=MagicMock(return_value=(1,)))
+        ]
+
+        response = self.server.AdoptAnimal(animal_posts_pb2.AdoptAnimalRequest(postId=1), self.context)
+        self.assertEqual(response.status_code, 409)
+        self.context.set_code.assert_called_with(grpc.StatusCode.FAILED_PRECONDITION)
+
+    def test_adopt_missing_animal(self):
+        self.session.execute.return_value.fetchone.return_value = None
+
+        response = self.server.AdoptAnimal(animal_posts_pb2.AdoptAnimalRequest(postId=99), self.context)
+        self.assertEqual(response.status_code, 404)
+        self.context.set_code.assert_called_with(grpc.StatusCode.NOT_FOUND)
+
+    @patch('server.transaction_store')
+    def test_prepare_batch_locks_posts_once(self, mock_store):
+        mock_store.lock.return_value = True
+        self.session.execute.return_value.fetchall.return_value = [
+            MagicMock(id=1, status="available", version=1),
+            MagicMock(id=2, status="available", version=4)
+        ]
+
+        request = animal_posts_pb2.TransactionRequest(transaction_id="t1", operation="adopt", post_ids=[1, 2])
+        response = self.server.Prepare(request, self.context)
+        self.assertTrue(response.success)
+        mock_store.lock.assert_called_once_with("t1", [1, 2])
+        mock_store.prepare.assert_called_once_with("t1", {}, [1, 2], {1: 1, 2: 4})
+
+    @patch('server.transaction_store')
+    def test_prepare_accepts_string_post_id_in_payload(self, mock_store):
+        mock_store.lock.return_value = True
+        self.session.execute.return_value.fetchall.return_value = [MagicMock(id=5, status="available", version=2)]
+
+        request = animal_posts_pb2.TransactionRequest(transaction_id="t1", operation="adopt", payload='{"postId": "5"}')
+        response = self.server.Prepare(request, self.context)
+        self.assertTrue(response.success)
+        mock_store.lock.assert_called_once_with("t1", [5])
+
+    @patch('server.transaction_store')
+    def test_prepare_rejects_invalid_post_id(self, mock_store):
+        request = animal_posts_pb2.TransactionRequest(transaction_id="t1", operation="adopt", payload='{"postId": "five"}')
+        response = self.server.Prepare(request, self.context)
+        self.assertFalse(response.success)
+        self.context.set_code.assert_called_with(grpc.StatusCode.INVALID_ARGUMENT)
+        mock_store.lock.assert_not_called()
+
+    @patch('server.transaction_store')
+    def test_prepare_failure_releases_its_locks(self, mock_store):
+        mock_store.lock.return_value = True
+        self.session.execute.side_effect = Exception("database is down")
+
+        request = animal_posts_pb2.TransactionRequest(transaction_id="t1", operation="adopt", post_ids=[1, 2])
+        response = self.server.Prepare(request, self.context)
+        self.assertFalse(response.success)
+        self.context.set_code.assert_called_with(grpc.StatusCode.INTERNAL)
+        mock_store.unlock.assert_called_once_with("t1", [1, 2])
+
+    @patch('server.transaction_store')
+    def test_commit_batch_aborts_when_a_post_changed(self, mock_store):
+        mock_store.claim.return_value = "prepared"
+        mock_store.get.return_value = {"state": "prepared", "payload": {}, "post_ids": [1, 2], "versions": {1: 1, 2: 4}}
+        self.session.execute.return_value.fetchall.return_value = [
+            MagicMock(id=1, title="Dog", description="A friendly dog", location="Shelter", status="unavailable")
+        ]
+
+        request = animal_posts_pb2.TransactionRequest(transaction_id="t1", operation="adopt")
+        response = self.server.Commit(request, self.context)
+        self.assertFalse(response.success)
+        self.session.rollback.assert_called_once()
+        self.session.commit.assert_not_called()
+        mock_store.finish.assert_called_once_with("t1", mock_store.get.return_value, "aborted")
+        mock_store.claim.assert_called_once_with("t1", "prepared", "committing")
+
+    @patch('server.transaction_store')
+    def test_duplicate_commit_returns_the_recorded_outcome(self, mock_store):
+        mock_store.claim.return_value = "committed"
+
+        request = animal_posts_pb2.TransactionRequest(transaction_id="t1", operation="adopt")
+        response = self.server.Commit(request, self.context)
+        self.assertTrue(response.success)
+        self.context.set_code.assert_not_called()
+        self.session.execute.assert_not_called()
+        mock_store.finish.assert_not_called()
+
+    @patch('server.transaction_store')
+    def test_commit_in_progress_elsewhere_is_not_aborted(self, mock_store):
+        mock_store.claim.return_value = "committing"
+
+        request = animal_posts_pb2.TransactionRequest(transaction_id="t1", operation="adopt")
+        response = self.server.Commit(request, self.context)
+        self.assertFalse(response.success)
+        self.context.set_code.assert_called_with(grpc.StatusCode.UNAVAILABLE)
+        mock_store.finish.assert_not_called()
+
+    @patch('server.transaction_store')
+    def test_failed_commit_returns_the_transaction_to_prepared(self, mock_store):
+        mock_store.claim.return_value = "prepared"
+        mock_store.get.return_value = {"state": "committing", "payload": {}, "post_ids": [1], "versions": {1: 1}}
+        self.session.execute.side_effect = Exception("database is down")
+
+        request = animal_posts_pb2.TransactionRequest(transaction_id="t1", operation="adopt")
+        response = self.server.Commit(request, self.context)
+        self.assertFalse(response.success)
+        mock_store.claim.assert_called_with("t1", "committing", "prepared")
+
+    def test_expired_deadline_skips_the_task(self):
+        self.context.time_remaining.return_value = 0
+
+        response = self.server.GetAnimals(animal_posts_pb2.Empty(), self.context)
+        self.assertEqual(response.status_code, 408)
+        self.context.set_code.assert_called_with(grpc.StatusCode.DEADLINE_EXCEEDED)
+        self.session.execute.assert_not_called()
+
+    def test_aio_service_runs_handlers_on_worker_pool(self):
+        self.session.execute.return_value.fetchall.return_value = [
+            MagicMock(id=1, title="Dog", description="A friendly dog", location="Shelter", status="available")
+        ]
+        service = AsyncAnimalService(self.server, async_engine=None)
+
+        request = animal_posts_pb2.AnimalPageRequest(page_size=10)
+        response = asyncio.run(service.GetAnimalsPage(request, self.context))
+        self.assertEqual(response.posts[0].title, "Dog")
+        self.assertEqual(response.next_cursor, "")
+
+    def test_aio_service_searches_on_the_event_loop(self):
+        conn = AsyncMock()
+        conn.execute.return_value = MagicMock(fetchall=MagicMock(return_value=[
+            MagicMock(id=8, title="Black cat", description="A shy cat", location="Park", status="available")
+        ]))
+        async_engine = MagicMock()
+        async_engine.connect.return_value.__aenter__.return_value = conn
+        service = AsyncAnimalService(self.server, async_engine)
+
+        request = animal_posts_pb2.SearchAnimalsRequest(query="cat", page_size=2)
+        response = asyncio.run(service.SearchAnimals(request, self.context))
+        self.assertEqual([post.postId for post in response.posts], [8])
+        self.assertEqual(response.next_cursor, "")
+        self.session.execute.assert_not_called()
+
+    def test_aio_service_reads_stats_from_async_redis(self):
+        async_redis = AsyncMock()
+        async_redis.hgetall.return_value = {b"total": b"3", b"status:available": b"3", b"location:Park": b"3"}
+        service = AsyncAnimalService(self.server, async_engine=MagicMock(), async_redis=async_redis)
+
+        response = asyncio.run(service.GetStats(animal_posts_pb2.Empty(), self.context))
+        self.assertEqual(response.total, 3)
+        self.assertEqual(dict(response.by_location), {"Park": 3})
+        async_redis.hgetall.assert_awaited_once_with("animals:stats")
+        self.session.execute.assert_not_called()
+
+    @patch('server.worker_pool')
+    def test_aio_get_load_skips_the_worker_pool(self, mock_pool):
+        mock_pool._work_queue.qsize.return_value = 4
+        async_redis = AsyncMock()
+        async_redis.hgetall.return_value = {b"total": b"10"}
+        service = AsyncAnimalService(self.server, async_engine=MagicMock(), async_redis=async_redis)
+
+        response = asyncio.run(service.GetLoad(animal_posts_pb2.Empty(), self.context))
+        self.assertEqual(response.total_posts, 10)
+        self.assertEqual(response.queue_depth, 4)
+        mock_pool.submit.assert_not_called()
+
+    def test_aio_get_load_when_the_count_fails(self):
+        async_engine = MagicMock()
+        async_engine.connect.side_effect = Exception("database is down")
+        service = AsyncAnimalService(self.server, async_engine=async_engine)
+
+        response = asyncio.run(service.GetLoad(animal_posts_pb2.Empty(), self.context))
+        self.assertEqual(response.total_posts, 0)
+        self.context.set_code.assert_not_called()
+
+    def test_check_status(self):
         request = animal_posts_pb2.Empty()
         response = self.server.CheckStatus(request, self.context)
         self.assertEqual(response.status, "Service is running")
 
-    @patch('server.db')
-    def test_get_load(self, mock_db):
-        mock_db.session.query.return_value.count.return_value = 10
+    @patch('server.post_stats')
+    def test_get_load(self, mock_stats):
+        mock_stats.get.return_value = {"total": 10, "by_status": {}, "by_location": {}}
 
         request = animal_posts_pb2.Empty()
         response = self.server.GetLoad(request, self.context)
-        self.assertEqual(response.load, 10)
+        self.assertEqual(response.total_posts, 10)
+        self.assertEqual(response.load, 0)
+        self.session.execute.assert_not_called()
+
+    @patch('server.post_stats')
+    def test_get_load_without_counters_or_time_left(self, mock_stats):
+        mock_stats.get.return_value = None
+        self.context.time_remaining.return_value = 0
+
+        response = self.server.GetLoad(animal_posts_pb2.Empty(), self.context)
+        self.assertEqual(response.total_posts, 0)
+        self.session.execute.assert_not_called()
+        self.context.set_code.assert_not_called()
+
+    @patch('server.post_stats')
+    def test_get_load_when_the_count_fails(self, mock_stats):
+        mock_stats.get.return_value = None
+        self.session.execute.side_effect = Exception("database is down")
+
+        response = self.server.GetLoad(animal_posts_pb2.Empty(), self.context)
+        self.assertEqual(response.total_posts, 0)
+        self.context.set_code.assert_not_called()
+
+    @patch('server.post_stats')
+    @patch('server.count_posts')
+    def test_get_load_when_the_count_times_out(self, mock_count, mock_stats):
+        mock_stats.get.return_value = None
+        mock_count.side_effect = lambda: time.sleep(0.5)
+        self.context.time_remaining.return_value = 0.05
+
+        response = self.server.GetLoad(animal_posts_pb2.Empty(), self.context)
+        self.assertEqual(response.total_posts, 0)
+        self.context.set_code.assert_not_called()
+
+    def test_get_stats_falls_back_to_database(self):
+        self.session.execute.return_value.fetchall.return_value = [
+            ("available", "Park", 2), ("available", "Home", 1), ("unavailable", "Park", 4)
+        ]
+
+        response = self.server.GetStats(animal_posts_pb2.Empty(), self.context)
+        self.assertEqual(response.total, 7)
+        self.assertEqual(dict(response.by_status), {"available": 3, "unavailable": 4})
+        self.assertEqual(dict(response.by_location), {"Park": 6, "Home": 1})
+
+
+class TestUpgradeSchema(unittest.TestCase):
+
+    def test_existing_table_gets_the_version_column_and_indexes(self):
+        connection = MagicMock()
+        connection.dialect = postgresql.dialect()
+
+        upgrade_schema(connection)
+        statements = [str(call.args[0].compile(dialect=postgresql.dialect())) for call in connection.execute.call_args_list]
+        self.assertIn("ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1", statements[0])
+        self.assertIn("CREATE EXTENSION IF NOT EXISTS pg_trgm", statements[1])
+        for index in animal_posts.indexes:
+            self.assertTrue(any(f"CREATE INDEX IF NOT EXISTS {index.name}" in statement for statement in statements[2:]))
+
+    def test_other_databases_are_left_alone(self):
+        connection = MagicMock()
+        connection.dialect.name = "sqlite"
+
+        upgrade_schema(connection)
+        connection.execute.assert_not_called()
+
+
+# dict-backed stand-in for the Redis commands the cache writes with, run in call order
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    def register_script(self, script):
+        return MagicMock()
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        return []
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def incr(self, key):
+        self.values[key] = int(self.values.get(key, 0)) + 1
+        return self.values[key]
+
+    def publish(self, channel, message):
+        return 0
+
+
+class TestAnimalCache(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = MagicMock()
+        self.pipe = self.redis.pipeline.return_value
+        self.cache = AnimalCache(self.redis, post_ttl=60, page_ttl=30)
+
+    def test_update_without_membership_change_keeps_pages(self):
+        old = animal_posts_pb2.AnimalPost(postId=1, title="Dog", location="Shelter", status="available")
+        new = animal_posts_pb2.AnimalPost(postId=1, title="Old dog", location="Shelter", status="available")
+
+        self.cache.post_updated(old, new)
+        self.pipe.set.assert_called_once()
+        self.pipe.incr.assert_not_called()
+
+    def test_status_change_bumps_old_and_new_status_scopes(self):
+        old = animal_posts_pb2.AnimalPost(postId=1, title="Dog", location="Shelter", status="available")
+        new = animal_posts_pb2.AnimalPost(postId=1, title="Dog", location="Shelter", status="unavailable")
+
+        self.cache.post_updated(old, new)
+        bumped = [call.args[0] for call in self.pipe.incr.call_args_list]
+        self.assertEqual(bumped, ["animals:gen:status:available", "animals:gen:status:unavailable"])
+
+    def test_page_load_does_not_overwrite_a_newer_post(self):
+        cache = AnimalCache(FakeRedis(), post_ttl=60, page_ttl=30)
+        old = animal_posts_pb2.AnimalPost(postId=1, title="Dog", location="Shelter", status="available")
+        new = animal_posts_pb2.AnimalPost(postId=1, title="Old dog", location="Shelter", status="available")
+
+        # a page load read the old row, then an update committed and wrote its post through
+        key = cache.page_key()
+        cache.post_updated(old, new)
+        cache.set_page(key, [old])
+
+        posts, _ = cache.get_page(key)
+        self.assertEqual(posts[0].title, "Old dog")
+
+    def test_page_hit_decodes_posts(self):
+        page = animal_posts_pb2.AnimalPageResponse(posts=[animal_posts_pb2.AnimalPost(postId=1)], next_cursor="Mg==")
+        self.redis.get.return_value = encode_message(page, 1024)
+        self.redis.mget.return_value = [encode_message(animal_posts_pb2.AnimalPost(postId=1, title="Dog"), 1024)]
+
+        posts, next_cursor = self.cache.get_page("animals:page:query:0")
+        self.assertEqual(posts[0].title, "Dog")
+        self.assertEqual(next_cursor, "Mg==")
+
+    def test_page_with_expired_post_is_a_miss(self):
+        page = animal_posts_pb2.AnimalPageResponse(posts=[animal_posts_pb2.AnimalPost(postId=1), animal_posts_pb2.AnimalPost(postId=2)])
+        self.redis.get.return_value = encode_message(page, 1024)
+        self.redis.mget.return_value = [encode_message(animal_posts_pb2.AnimalPost(postId=1, title="Dog"), 1024), None]
+        self.assertIsNone(self.cache.get_page("animals:page:query:0"))
+
+    def test_large_values_are_compressed(self):
+        post = animal_posts_pb2.AnimalPost(postId=1, description="friendly " * 200)
+        payload = encode_message(post, 1024)
+
+        self.assertLess(len(payload), post.ByteSize())
+        self.assertEqual(decode_message(payload, animal_posts_pb2.AnimalPost), post)
+        self.assertIsNone(decode_message(b'[{"postId": 1}]', animal_posts_pb2.AnimalPost))
+
+    def test_corrupt_values_are_a_miss(self):
+        self.assertIsNone(decode_message(bytes([1, 1]) + b"not zlib", animal_posts_pb2.AnimalPost))
+        self.assertIsNone(decode_message(bytes([1, 0]) + b"\xff\xff\xff", animal_posts_pb2.AnimalPost))
+
+        self.redis.get.return_value = bytes([1, 1]) + b"not zlib"
+        self.assertIsNone(self.cache.get_page("animals:page:query:0"))
+
+    def test_lease_held_elsewhere_serves_stale_page(self):
+        stale = ([animal_posts_pb2.AnimalPost(postId=1, title="Dog")], "")
+        self.redis.set.return_value = None
+        loader = MagicMock()
+
+        with patch.object(AnimalCache, 'get_page', side_effect=[None, stale]):
+            posts, _, source = self.cache.get_or_load_page("animals:page:query:0", loader)
+        self.assertEqual(source, "Redis (stale)")
+        self.assertEqual(posts[0].title, "Dog")
+        loader.assert_not_called()
+
+    def test_lease_wait_stops_at_the_request_deadline(self):
+        self.redis.set.return_value = None
+        loader = MagicMock()
+
+        started = time.monotonic()
+        with patch.object(AnimalCache, 'get_page', return_value=None):
+            with self.assertRaises(TimeoutError):
+                self.cache.get_or_load_page("animals:page:query:0", loader, deadline=started + 0.1)
+        self.assertLess(time.monotonic() - started, 1)
+        loader.assert_not_called()
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used_entry(self):
+        cache = LocalCache(max_entries=2, max_bytes=1024, ttl=60)
+        cache.set("a", b"page a", [1], ["all"], cache.version)
+        cache.set("b", b"page b", [2], ["all"], cache.version)
+        cache.get("a")
+        cache.set("c", b"page c", [3], ["all"], cache.version)
+
+        self.assertEqual(cache.get("a"), b"page a")
+        self.assertIsNone(cache.get("b"))
+
+    def test_invalidation_drops_entries_holding_the_post(self):
+        cache = LocalCache(max_entries=10, max_bytes=1024, ttl=60)
+        cache.set("available", b"page", [1, 2], ["status:available"], cache.version)
+        cache.set("adopted", b"page", [3], ["status:unavailable"], cache.version)
+
+        cache.invalidate([2], [])
+        self.assertIsNone(cache.get("available"))
+        self.assertEqual(cache.get("adopted"), b"page")
+
+    def test_response_built_during_invalidation_is_not_stored(self):
+        cache = LocalCache(max_entries=10, max_bytes=1024, ttl=60)
+        version = cache.version
+        cache.invalidate([1], ["all"])
+
+        cache.set("animals", b"page", [1], ["all"], version)
+        self.assertIsNone(cache.get("animals"))
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_calls_share_one_execution(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        def load():
+            calls.append(1)
+            time.sleep(0.2)
+            return "posts"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do("key", load))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["posts"] * 5)
+
+
+class TestPostStats(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = MagicMock()
+        self.pipe = self.redis.pipeline.return_value
+        self.stats = PostStats(self.redis)
+
+    def test_update_only_moves_changed_counters(self):
+        old = animal_posts_pb2.AnimalPost(postId=1, location="Park", status="available")
+        new = animal_posts_pb2.AnimalPost(postId=1, location="Park", status="unavailable")
+
+        self.stats.record(added=[new], removed=[old])
+        increments = {call.args[1]: call.args[2] for call in self.pipe.hincrby.call_args_list}
+        self.assertEqual(increments, {"status:unavailable": 1, "status:available": -1})
+
+    def test_get_drops_empty_counters(self):
+        self.redis.hgetall.return_value = {b"total": b"3", b"status:available": b"3", b"status:unavailable": b"0"}
+
+        self.assertEqual(self.stats.get(), {"total": 3, "by_status": {"available": 3}, "by_location": {}})
+
+
+class TestTransactionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = MagicMock()
+        self.pipe = self.redis.pipeline.return_value
+        self.store = TransactionStore(self.redis, prepared_ttl=60, finished_ttl=600)
+
+    def test_get_decodes_prepared_transaction(self):
+        self.redis.hgetall.return_value = {
+            b"state": b"prepared", b"payload": b'{"postId": 1}', b"post_ids": b"[1]", b"versions": b'{"1": 3}'
+        }
+
+        transaction = self.store.get("t1")
+        self.assertEqual(transaction, {"state": "prepared", "payload": {"postId": 1}, "post_ids": [1], "versions": {1: 3}})
+        self.redis.hgetall.assert_called_once_with("txn:t1")
+
+    def test_finish_releases_locks_and_expires_entry(self):
+        self.store.release_locks = MagicMock()
+
+        self.store.finish("t1", {"post_ids": [1, 2]}, "committed")
+        self.store.release_locks.assert_called_once_with(keys=["lock:post:1", "lock:post:2"], args=["t1"])
+        self.pipe.hset.assert_called_once_with("txn:t1", "state", "committed")
+        self.pipe.expire.assert_called_once_with("txn:t1", 600)
+
+
+# runs the Lua scripts of the store against fakeredis
+class TestTransactionLocks(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.store = TransactionStore(self.redis, prepared_ttl=60, finished_ttl=600)
+
+    def test_lock_is_all_or_nothing(self):
+        self.assertTrue(self.store.lock("t1", [1, 2]))
+
+        self.assertFalse(self.store.lock("t2", [2, 3]))
+        self.assertIsNone(self.redis.get("lock:post:3"))
+
+    def test_retried_lock_keeps_the_posts_of_its_transaction(self):
+        self.assertTrue(self.store.lock("t1", [1, 2]))
+
+        self.assertTrue(self.store.lock("t1", [1, 2]))
+        self.assertEqual(self.redis.get("lock:post:1"), b"t1")
+
+    def test_unlock_releases_only_own_locks(self):
+        self.store.lock("t1", [1])
+        self.store.lock("t2", [2])
+
+        self.store.unlock("t1", [1, 2])
+        self.assertIsNone(self.redis.get("lock:post:1"))
+        self.assertEqual(self.redis.get("lock:post:2"), b"t2")
+
+    def test_only_one_claim_wins(self):
+        self.store.prepare("t1", {}, [1], {1: 1})
+
+        self.assertEqual(self.store.claim("t1", "prepared", "committing"), "prepared")
+        self.assertEqual(self.store.claim("t1", "prepared", "committing"), "committing")
+        self.assertEqual(self.store.get("t1")["state"], "committing")
+        self.assertIsNone(self.store.claim("t2", "prepared", "committing"))
 
 
 if __name__ == '__main__':
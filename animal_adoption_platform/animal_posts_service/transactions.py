@@ -0,0 +1,103 @@
+#animal_posts_service/transactions.py
+import json
+
+# lock every post for a transaction, or none of them if another transaction holds any;
+# locks the transaction already holds, e.g. from a retried Prepare, are renewed
+ACQUIRE_LOCKS = """
+for i, key in ipairs(KEYS) do
+    local owner = redis.call('get', key)
+    if owner and owner ~= ARGV[1] then
+        return 0
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('set', key, ARGV[1], 'EX', ARGV[2])
+end
+return 1
+"""
+
+# delete a post lock only if it is still held by the given transaction
+RELEASE_LOCKS = """
+local released = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[1] then
+        released = released + redis.call('del', key)
+    end
+end
+return released
+"""
+
+# move a transaction to a new state if it is in the expected one, returning the state it was in
+CLAIM_TRANSACTION = """
+local state = redis.call('hget', KEYS[1], 'state')
+if state == ARGV[1] then
+    redis.call('hset', KEYS[1], 'state', ARGV[2])
+end
+return state
+"""
+
+
+# 2PC participant state in Redis, so Commit and Rollback may reach any replica
+class TransactionStore:
+    def __init__(self, client, prepared_ttl=60, finished_ttl=600):
+        self.client = client
+        self.prepared_ttl = prepared_ttl
+        self.finished_ttl = finished_ttl
+        self.acquire_locks = client.register_script(ACQUIRE_LOCKS) if client is not None else None
+        self.release_locks = client.register_script(RELEASE_LOCKS) if client is not None else None
+        self.claim_transaction = client.register_script(CLAIM_TRANSACTION) if client is not None else None
+
+    @staticmethod
+    def key(transaction_id):
+        return f"txn:{transaction_id}"
+
+    @staticmethod
+    def lock_key(post_id):
+        return f"lock:post:{post_id}"
+
+    # atomically lock posts for a transaction, failing if another transaction holds any of them
+    def lock(self, transaction_id, post_ids):
+        keys = [self.lock_key(post_id) for post_id in post_ids]
+        return bool(self.acquire_locks(keys=keys, args=[transaction_id, self.prepared_ttl]))
+
+    def unlock(self, transaction_id, post_ids):
+        if post_ids:
+            self.release_locks(keys=[self.lock_key(post_id) for post_id in post_ids], args=[transaction_id])
+
+    # atomically move a transaction from state to new_state, so only one replica acts on it;
+    # returns the state it was in, which is state only for the caller that moved it
+    def claim(self, transaction_id, state, new_state):
+        previous = self.claim_transaction(keys=[self.key(transaction_id)], args=[state, new_state])
+        return previous.decode() if previous is not None else None
+
+    # return the transaction as a dict, or None if it is unknown or expired
+    def get(self, transaction_id):
+        fields = self.client.hgetall(self.key(transaction_id))
+        if not fields:
+            return None
+        fields = {key.decode(): value.decode() for key, value in fields.items()}
+        return {
+            "state": fields["state"],
+            "payload": json.loads(fields["payload"]),
+            "post_ids": json.loads(fields["post_ids"]),
+            "versions": {int(post_id): version for post_id, version in json.loads(fields["versions"]).items()}
+        }
+
+    def prepare(self, transaction_id, payload, post_ids, versions):
+        pipe = self.client.pipeline()
+        pipe.hset(self.key(transaction_id), mapping={
+            "state": "prepared",
+            "payload": json.dumps(payload),
+            "post_ids": json.dumps(post_ids),
+            "versions": json.dumps(versions)
+        })
+        pipe.expire(self.key(transaction_id), self.prepared_ttl)
+        pipe.execute()
+
+    # record the outcome, release the transaction's locks and let the entry expire
+    def finish(self, transaction_id, transaction, state):
+        self.unlock(transaction_id, transaction["post_ids"])
+        pipe = self.client.pipeline()
+        pipe.hset(self.key(transaction_id), "state", state)
+        pipe.expire(self.key(transaction_id), self.finished_ttl)
+        pipe.execute()
@@ -1,12 +1,13 @@
+import threading
 import grpc
 import chat_pb2
 import chat_pb2_grpc
 
-def generate_messages(username):
+def generate_messages(username, room):
     #yield chat messages from the user
     while True:
         message = input(f"{username}, enter your message: ")
-        yield chat_pb2.MessageRequest(username=username, message=message)
+        yield chat_pb2.MessageRequest(username=username, message=message, room=room)
 
 def get_status(stub):
     #fetch and print the server status
@@ -16,16 +17,36 @@ def get_status(stub):
     except grpc.RpcError as e:
         print(f"Error getting status: {e.details()}")
 
+def print_history(stub, room):
+    #fetch and print the latest page of the room's history
+    try:
+        response = stub.GetChatHistory(chat_pb2.ChatHistoryRequest(room=room))
+        for message in response.messages:
+            print(message)
+    except grpc.RpcError as e:
+        print(f"Error getting chat history: {e.details()}")
+
+def listen(stub, room):
+    #print messages pushed by the server as they are added to the room
+    try:
+        for message in stub.Subscribe(chat_pb2.SubscribeRequest(room=room)):
+            print(f"\n[{room}] {message.username}: {message.message}")
+    except grpc.RpcError as e:
+        print(f"Error in Subscribe: {e.details()}")
+
 def run():
     #start the client and handle chat streaming
     channel = grpc.insecure_channel('localhost:50051')
     stub = chat_pb2_grpc.ChatStub(channel)
     username = input("Enter your username: ")
+    room = input("Enter a room (lobby): ") or "lobby"
     get_status(stub)
+    print_history(stub, room)
+    threading.Thread(target=listen, args=(stub, room), daemon=True).start()
 
     try:
         # start streaming chat messages
-        responses = stub.ChatStream(generate_messages(username))
+        responses = stub.ChatStream(generate_messages(username, room))
         # listen for responses from the server
         for response in responses:
             print(f"Server response: {response.response}")
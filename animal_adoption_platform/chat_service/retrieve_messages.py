@@ -1,14 +1,19 @@
+import sys
 import redis
 
-def get_chat_history():
+def get_chat_history(room="lobby", page_size=100):
     redis_client = redis.StrictRedis(host='localhost', port=6379, db=0, decode_responses=True)
-    messages = redis_client.lrange("chat_messages", 0, -1)
-    if messages:
-        print("Chat History:")
-        for message in messages:
-            print(message)
-    else:
+    # walk the room's stream newest first, one page at a time
+    entries = redis_client.xrevrange(f"chat:stream:{room}", count=page_size)
+    if not entries:
         print("No messages found.")
+        return
+
+    print("Chat History:")
+    while entries:
+        for message_id, fields in entries:
+            print(f"{message_id} {fields.get('username')}: {fields.get('message')}")
+        entries = redis_client.xrevrange(f"chat:stream:{room}", max=f"({entries[-1][0]}", count=page_size)
 
 if __name__ == '__main__':
-    get_chat_history()
+    get_chat_history(*sys.argv[1:2])
@@ -1,5 +1,7 @@
 import grpc
 from concurrent import futures
+import os
+import re
 import time
 import redis
 import chat_pb2
@@ -8,32 +10,107 @@ import chat_pb2_grpc
 # initialize redis client
 redis_client = redis.StrictRedis(host='localhost', port=6379, db=0, decode_responses=True)
 
+# every room is a Redis stream trimmed to about CHAT_STREAM_MAXLEN messages
+CHAT_STREAM_MAXLEN = int(os.getenv('CHAT_STREAM_MAXLEN', 10000))
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', 50))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_MAX_PAGE_SIZE', 200))
+# how long a subscriber's XREAD blocks before checking that its call is still active
+CHAT_SUBSCRIBE_BLOCK_MS = int(os.getenv('CHAT_SUBSCRIBE_BLOCK_MS', 5000))
+# worker threads, each open ChatStream or Subscribe call holds one
+max_concurrent_tasks = int(os.getenv('CHAT_MAX_WORKERS', 32))
+
+
+# stream ids are "<ms>-<seq>", two unsigned 64-bit numbers
+STREAM_ID = re.compile(r"(\d{1,20})-(\d{1,20})")
+
+
+def stream_key(room):
+    return f"chat:stream:{room or 'lobby'}"
+
+
+# return a client-supplied stream id as (ms, seq), or None if Redis would reject it
+def parse_stream_id(value):
+    match = STREAM_ID.fullmatch(value)
+    if match is None:
+        return None
+    parts = tuple(int(part) for part in match.groups())
+    return parts if all(part < 2 ** 64 for part in parts) else None
+
+
+def to_chat_message(room, message_id, fields):
+    return chat_pb2.ChatMessage(
+        id=message_id,
+        room=room or 'lobby',
+        username=fields.get('username', ''),
+        message=fields.get('message', ''),
+        timestamp=int(message_id.split('-')[0])
+    )
+
 class ChatServicer(chat_pb2_grpc.ChatServicer):
     def ChatStream(self, request_iterator, context):
         for request in request_iterator:
             print(f"Received message from {request.username}: {request.message}")
             
-            #saving the message to redis
-            redis_client.rpush("chat_messages", f"{request.username}: {request.message}")
+            #saving the message to the stream of its room, approximate trimming keeps XADD cheap
+            message_id = redis_client.xadd(
+                stream_key(request.room),
+                {"username": request.username, "message": request.message},
+                maxlen=CHAT_STREAM_MAXLEN,
+                approximate=True
+            )
 
             # yield a response immediately after saving the message
-            yield chat_pb2.MessageResponse(response=f"Message  received!")
+            yield chat_pb2.MessageResponse(response=f"Message  received!", id=message_id)
     #return the current status of the server   
     def GetStatus(self, request, context):
         return chat_pb2.StatusResponse(status="\nServer is running")
     
-    #retrieve chat history from the Redis database
+    #retrieve one page of a room's history from its Redis stream, newest page first
     def GetChatHistory(self, request, context):
-        messages = redis_client.lrange("chat_messages", 0, -1)
+        # nothing precedes 0-0, so it can not be the cursor of a page
+        if request.before and parse_stream_id(request.before) in (None, (0, 0)):
+            context.set_details('Invalid history cursor')
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            return chat_pb2.ChatHistoryResponse()
+
+        page_size = max(1, min(request.page_size or CHAT_HISTORY_PAGE_SIZE, CHAT_HISTORY_MAX_PAGE_SIZE))
+        # one extra message tells whether an older page exists
+        entries = redis_client.xrevrange(
+            stream_key(request.room),
+            max=f"({request.before}" if request.before else "+",
+            min="-",
+            count=page_size + 1
+        )
+        before = entries[page_size - 1][0] if len(entries) > page_size else ""
+        messages = [to_chat_message(request.room, message_id, fields) for message_id, fields in reversed(entries[:page_size])]
+        return chat_pb2.ChatHistoryResponse(
+            messages=[f"{message.username}: {message.message}" for message in messages],
+            entries=messages,
+            before=before
+        )
+
+    #push the new messages of a room to the client until it cancels the call
+    def Subscribe(self, request, context):
+        key = stream_key(request.room)
+        last_id = request.last_id
+        if last_id and parse_stream_id(last_id) is None:
+            context.set_details('Invalid last_id')
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            return
+        if not last_id:
+            # start after the newest message now, so nothing added between two reads is missed
+            newest = redis_client.xrevrange(key, count=1)
+            last_id = newest[0][0] if newest else "0-0"
 
-        if messages:
-            return chat_pb2.ChatHistoryResponse(messages=messages)
-        else:
-            return chat_pb2.ChatHistoryResponse(messages=[])
+        while context.is_active():
+            for _, entries in redis_client.xread({key: last_id}, count=100, block=CHAT_SUBSCRIBE_BLOCK_MS) or []:
+                for message_id, fields in entries:
+                    last_id = message_id
+                    yield to_chat_message(request.room, message_id, fields)
 
 
 def start_serv():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_concurrent_tasks))
     #adding the ChatServicer to the server
     chat_pb2_grpc.add_ChatServicer_to_server(ChatServicer(), server)
     server.add_insecure_port('[::]:50051')
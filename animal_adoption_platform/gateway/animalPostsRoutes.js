@@ -92,6 +92,29 @@ router.post('/', async (req, res) => {
     }
 });
 
+// Create Many Animal Posts in one call (bulk shelter imports)
+router.post('/batch', async (req, res) => {
+    const posts = (req.body.posts || []).map(({ title, description, location, status }) => ({ title, description, location, status }));
+
+    try {
+        const response = await circuitBreaker.callService(() => {
+            return new Promise((resolve, reject) => {
+                animalPostsClient.CreateAnimalPosts({ posts }, (error, response) => {
+                    if (error) return reject(error);
+                    resolve(response);
+                });
+            });
+        });
+
+        // Clear Cache After Creating Posts
+        await clearRedisCache('animalPosts');
+
+        res.status(200).json({ message: response.message, postIds: response.postIds });
+    } catch (error) {
+        res.status(500).json({ error: error.details || 'Service unavailable' });
+    }
+});
+
 // Update Animal Post
 router.put('/:postId', async (req, res) => {
     const { postId } = req.params;
@@ -150,6 +173,46 @@ router.get('/', async (req, res) => {
     }
 });
 
+// Stream Animal Posts as NDJSON, forwarding each post as soon as the service yields it
+router.get('/stream', (req, res) => {
+    const { status = '', location = '' } = req.query;
+    const call = animalPostsClient.ListAnimals({ status, location });
+
+    res.status(200).type('application/x-ndjson');
+    call.on('data', (post) => res.write(JSON.stringify(post) + '\n'));
+    call.on('end', () => res.end());
+    call.on('error', (error) => {
+        console.error('Error in ListAnimals stream:', error.message);
+        if (!res.headersSent) {
+            return res.status(500).json({ error: error.details || 'Service unavailable' });
+        }
+        res.end();
+    });
+
+    // Stop the server-side cursor when the HTTP client disconnects
+    req.on('close', () => call.cancel());
+});
+
+// Search Animal Posts by text and location, ranked by relevance
+router.get('/search', async (req, res) => {
+    const { q = '', location = '', status = '', cursor = '' } = req.query;
+    const request = { query: q, location, status, cursor, page_size: Number(req.query.page_size) || 0 };
+
+    try {
+        const response = await circuitBreaker.callService(() => {
+            return new Promise((resolve, reject) => {
+                animalPostsClient.SearchAnimals(request, (error, response) => {
+                    if (error) return reject(error);
+                    resolve(response);
+                });
+            });
+        });
+        res.status(200).json({ posts: response.posts, next_cursor: response.next_cursor });
+    } catch (error) {
+        res.status(500).json({ error: error.details || 'Service unavailable' });
+    }
+});
+
 // Delete Animal Post
 router.delete('/:postId', async (req, res) => {
     const { postId } = req.params;
@@ -269,7 +269,7 @@ app.post('/db/test-insert', async (req, res) => {
 app.get('/db/get-messages/:room', async (req, res) => {
     const { room } = req.params;
     try {
-        const response = await axios.get(`${CHAT_API_URL}/get_messages/${room}`);
+        const response = await axios.get(`${CHAT_API_URL}/get_messages/${room}`, { params: req.query });
         res.status(response.status).json(response.data);
     } catch (error) {
         console.error('Error retrieving messages:', error.message);
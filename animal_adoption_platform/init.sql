@@ -1,8 +1,19 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 CREATE TABLE animal_posts (
     id SERIAL PRIMARY KEY,
     title VARCHAR(100) NOT NULL,
     description TEXT NOT NULL,
     location VARCHAR(100) NOT NULL,
     status VARCHAR(50) NOT NULL,
-    images VARCHAR(255)
+    images VARCHAR(255),
+    version INTEGER NOT NULL DEFAULT 1
 );
+
+CREATE INDEX IF NOT EXISTS idx_animal_posts_status_id ON animal_posts (status, id);
+CREATE INDEX IF NOT EXISTS idx_animal_posts_location_id ON animal_posts (location, id);
+
+-- Indexes backing SearchAnimals: full-text over title and description, fuzzy matching on location
+CREATE INDEX IF NOT EXISTS idx_animal_posts_search ON animal_posts
+    USING GIN (to_tsvector('simple'::regconfig, title || ' ' || description));
+CREATE INDEX IF NOT EXISTS idx_animal_posts_location_trgm ON animal_posts USING GIN (location gin_trgm_ops);
@@ -0,0 +1,44 @@
+#new_chat/broadcast.py
+import asyncio
+import websockets.exceptions
+
+# asyncio only keeps weak references to tasks, so pending closes are held here until done
+closing_tasks = set()
+
+
+# bounded outgoing frame queue of one websocket connection, drained by its own task
+class ClientSender:
+    def __init__(self, websocket, max_queue=256, policy="disconnect", binary=False):
+        self.websocket = websocket
+        self.policy = policy
+        self.binary = binary
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.closed = False
+        self._task = asyncio.create_task(self._run())
+
+    # queue an encoded frame, returning False if the client is too slow to take it
+    def send(self, frame):
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            if self.policy == "disconnect":
+                self.closed = True
+                task = asyncio.create_task(self.websocket.close(1013, "Client too slow"))
+                closing_tasks.add(task)
+                task.add_done_callback(closing_tasks.discard)
+            return False
+
+    def close(self):
+        self.closed = True
+        self._task.cancel()
+
+    async def _run(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                await self.websocket.send(frame, text=not self.binary)
+        except websockets.exceptions.ConnectionClosed:
+            self.closed = True
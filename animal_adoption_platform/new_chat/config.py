@@ -0,0 +1,44 @@
+import os
+
+# a replica set, adoptions store their chat message in a transaction
+MONGO_URI = os.getenv('DATABASE_URL', 'mongodb://mongo:27017/chat_db?replicaSet=rs0')
+# Connections per MongoDB client; the websocket server shares one async client across all connections
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+
+# Messages returned by one history request when the client does not ask for a count, and the upper bound
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', 50))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_MAX_PAGE_SIZE', 200))
+# Latest messages of each room kept in Redis to serve the first history page; idle rooms expire after CHAT_RECENT_TTL seconds
+CHAT_RECENT_MESSAGES = int(os.getenv('CHAT_RECENT_MESSAGES', 100))
+CHAT_RECENT_TTL = int(os.getenv('CHAT_RECENT_TTL', 86400))
+
+# Chat messages are stored in insert_many batches of up to CHAT_WRITE_BATCH_SIZE, flushed at most
+# CHAT_WRITE_LINGER_MS after their first message; senders wait once CHAT_WRITE_MAX_PENDING are buffered
+CHAT_WRITE_BATCH_SIZE = int(os.getenv('CHAT_WRITE_BATCH_SIZE', 500))
+CHAT_WRITE_LINGER_MS = float(os.getenv('CHAT_WRITE_LINGER_MS', 5))
+CHAT_WRITE_MAX_PENDING = int(os.getenv('CHAT_WRITE_MAX_PENDING', 10000))
+
+# Broadcast frames queued per websocket; when a client falls this far behind its frames are
+# dropped ("drop") or the connection is closed so it reconnects and reloads history ("disconnect")
+CHAT_SEND_QUEUE_SIZE = int(os.getenv('CHAT_SEND_QUEUE_SIZE', 256))
+CHAT_SLOW_CLIENT_POLICY = os.getenv('CHAT_SLOW_CLIENT_POLICY', 'disconnect')
+
+# Admission control: messages per second (and burst) per connection, largest accepted frame,
+# handlers running at once across all connections, and members per room on one instance
+CHAT_RATE_LIMIT = float(os.getenv('CHAT_RATE_LIMIT', 10))
+CHAT_RATE_BURST = int(os.getenv('CHAT_RATE_BURST', 20))
+CHAT_MAX_MESSAGE_BYTES = int(os.getenv('CHAT_MAX_MESSAGE_BYTES', 64 * 1024))
+CHAT_MAX_IN_FLIGHT = int(os.getenv('CHAT_MAX_IN_FLIGHT', 100))
+CHAT_MAX_ROOM_MEMBERS = int(os.getenv('CHAT_MAX_ROOM_MEMBERS', 10000))
+
+# permessage-deflate offered to websocket clients ("deflate"), or "" to send frames uncompressed;
+# clients choose msgpack frames by offering the chat.msgpack subprotocol
+CHAT_COMPRESSION = os.getenv('CHAT_COMPRESSION', 'deflate')
+
+# Animal posts gRPC service used for adoptions: ANIMAL_SERVICE_TARGET if set, else the address registered
+# in service discovery, else the compose service name; calls are balanced round robin over its replicas
+SERVICE_DISCOVERY_URL = os.getenv('SERVICE_DISCOVERY_URL', 'http://service_discovery:3001')
+ANIMAL_SERVICE_TARGET = os.getenv('ANIMAL_SERVICE_TARGET', '')
+ANIMAL_SERVICE_DEFAULT_TARGET = 'animal_posts_service:50052'
+# Deadline in seconds of one AdoptAnimal call
+ADOPT_TIMEOUT = float(os.getenv('ADOPT_TIMEOUT', 5))
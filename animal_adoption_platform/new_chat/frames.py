@@ -0,0 +1,56 @@
+#new_chat/frames.py
+import json
+import msgpack
+
+JSON = "chat.json"
+MSGPACK = "chat.msgpack"
+# fields the handlers use as text; null is accepted, e.g. the "before" of the last history page sent back
+TEXT_FIELDS = ("action", "room", "username", "message", "before")
+
+
+# prefer msgpack frames when offered; clients offering none of ours still talk plain JSON text frames
+def select_subprotocol(connection, subprotocols):
+    for subprotocol in (MSGPACK, JSON):
+        if subprotocol in subprotocols:
+            return subprotocol
+    return None
+
+
+def is_binary(websocket):
+    return websocket.subprotocol == MSGPACK
+
+
+# msgpack bin and ext values have no JSON form, so they could not be stored, broadcast or sent in history
+def is_json_value(value):
+    if isinstance(value, dict):
+        return all(isinstance(key, str) and is_json_value(item) for key, item in value.items())
+    if isinstance(value, list):
+        return all(is_json_value(item) for item in value)
+    return isinstance(value, (str, int, float, bool, type(None)))
+
+
+# decode an incoming frame into a message object: binary frames are msgpack, text frames JSON
+def decode(message):
+    if isinstance(message, bytes):
+        data = msgpack.unpackb(message)
+    else:
+        data = json.loads(message)
+
+    if not isinstance(data, dict) or not is_json_value(data):
+        raise ValueError("A frame must hold a JSON object")
+    for field in TEXT_FIELDS:
+        if not isinstance(data.get(field), (str, type(None))):
+            raise ValueError(f"'{field}' must be a string")
+    return data
+
+
+# encode a payload for one connection, returning the frame as bytes
+def encode(payload, binary):
+    if binary:
+        return msgpack.packb(payload)
+    return json.dumps(payload).encode()
+
+
+# re-encode a JSON broadcast frame as msgpack without building it again
+def transcode(message):
+    return msgpack.packb(json.loads(message))
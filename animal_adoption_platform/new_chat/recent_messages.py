@@ -0,0 +1,95 @@
+#new_chat/recent_messages.py
+import json
+import redis
+
+# oldest entry of a buffer that holds the whole history of its room
+HISTORY_START = {"start": True}
+
+# fill the buffer of a room from a database read; messages pushed since the read are only
+# in the buffer, so it is replaced only when every buffered message is part of the read
+WARM_BUFFER = """
+local read = {}
+for i = 2, #ARGV do
+    local cursor = cjson.decode(ARGV[i]).cursor
+    if cursor then
+        read[cursor] = true
+    end
+end
+for _, entry in ipairs(redis.call('lrange', KEYS[1], 0, -1)) do
+    local cursor = cjson.decode(entry).cursor
+    if cursor and not read[cursor] then
+        return 0
+    end
+end
+redis.call('del', KEYS[1])
+redis.call('rpush', KEYS[1], unpack(ARGV, 2))
+redis.call('expire', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+# newest-first Redis list of the last messages of each room, serving the latest history page
+class RecentMessages:
+    def __init__(self, client, size=100, ttl=86400):
+        self.client = client
+        self.size = size
+        self.ttl = ttl
+        self.warm_buffer = client.register_script(WARM_BUFFER) if client is not None else None
+
+    @staticmethod
+    def key(room_name):
+        return f"chat:recent:{room_name}"
+
+    async def push(self, room_name, entry):
+        await self.push_many([(room_name, entry)])
+
+    # buffer (room, entry) pairs in one round trip, each room in the given order
+    async def push_many(self, entries):
+        if self.client is None or not entries:
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for room_name, entry in entries:
+                pipe.lpush(self.key(room_name), json.dumps(entry))
+            for room_name in dict.fromkeys(room_name for room_name, _ in entries):
+                pipe.ltrim(self.key(room_name), 0, self.size - 1)
+                pipe.expire(self.key(room_name), self.ttl)
+            await pipe.execute()
+        except redis.RedisError as e:
+            print(f"Failed to buffer messages: {e}")
+
+    # return (history oldest first, cursor of the previous page or None), or None on a miss
+    async def latest(self, room_name, limit):
+        # one extra entry tells whether an older page exists
+        if self.client is None or limit + 1 > self.size:
+            return None
+        try:
+            entries = await self.client.lrange(self.key(room_name), 0, limit)
+        except redis.RedisError as e:
+            print(f"Failed to read buffered messages of room {room_name}: {e}")
+            return None
+
+        entries = [json.loads(entry) for entry in entries]
+        if entries and entries[-1] == HISTORY_START:
+            entries.pop()
+        elif len(entries) <= limit:
+            return None
+
+        older = entries[limit - 1]["cursor"] if len(entries) > limit else None
+        history = [{key: value for key, value in entry.items() if key != "cursor"} for entry in reversed(entries[:limit])]
+        return history, older
+
+    # seed the buffer with newest-first entries read from the database; complete means
+    # the read reached the first message of the room
+    async def warm(self, room_name, entries, complete=False):
+        if self.client is None:
+            return
+        values = [json.dumps(entry) for entry in entries[:self.size]]
+        if complete and len(entries) < self.size:
+            values.append(json.dumps(HISTORY_START))
+        if not values:
+            return
+        try:
+            await self.warm_buffer(keys=[self.key(room_name)], args=[self.ttl, *values])
+        except redis.RedisError as e:
+            print(f"Failed to warm buffered messages of room {room_name}: {e}")
@@ -0,0 +1,61 @@
+#new_chat/room_bus.py
+import asyncio
+import redis
+
+
+# room messages shared by every new_chat instance through Redis pub/sub
+class RoomBus:
+    prefix = "chat:room:"
+
+    def __init__(self, client, deliver):
+        self.client = client
+        self.deliver = deliver
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True) if client is not None else None
+        self._task = None
+
+    def channel(self, room_name):
+        return f"{self.prefix}{room_name}"
+
+    def start(self):
+        if self.pubsub is not None:
+            self._task = asyncio.create_task(self.pubsub.run(exception_handler=self._on_listener_error))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            await self.pubsub.aclose()
+
+    async def subscribe(self, room_name):
+        if self.pubsub is None:
+            return
+        try:
+            await self.pubsub.subscribe(**{self.channel(room_name): self._on_message})
+        except redis.RedisError as e:
+            print(f"Failed to subscribe to room {room_name}: {e}")
+
+    async def unsubscribe(self, room_name):
+        if self.pubsub is None:
+            return
+        try:
+            await self.pubsub.unsubscribe(self.channel(room_name))
+        except redis.RedisError as e:
+            print(f"Failed to unsubscribe from room {room_name}: {e}")
+
+    async def publish(self, room_name, frame):
+        if self.client is not None:
+            try:
+                await self.client.publish(self.channel(room_name), frame)
+                return
+            except redis.RedisError as e:
+                print(f"Failed to publish to room {room_name}, delivering locally: {e}")
+        await self.deliver(room_name, frame)
+
+    async def _on_message(self, message):
+        channel = message["channel"].decode()
+        await self.deliver(channel[len(self.prefix):], message["data"].decode())
+
+    async def _on_listener_error(self, e, pubsub):
+        # the listener reconnects and resubscribes on the next poll
+        print(f"Room bus listener failed: {e}")
+        await asyncio.sleep(1)
@@ -2,14 +2,28 @@
 import asyncio
 import time
 import websockets
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient, MongoClient, DESCENDING
+import bson
+from bson import ObjectId
 import datetime
 import requests
 import json
 import grpc
 from prometheus_flask_exporter import PrometheusMetrics, NO_PREFIX
+import animal_posts_pb2
 import animal_posts_pb2_grpc
 import logging
+import signal
+import sys
+from write_behind import MessageWriter
+from room_bus import RoomBus
+from broadcast import ClientSender
+from recent_messages import RecentMessages
+from prometheus_client import Counter, Gauge, Histogram
+from admission import TokenBucket
+import frames
+import contextlib
+import redis.asyncio
 from flask import Flask, request
 
 logger = logging.getLogger(__name__)
@@ -24,32 +38,55 @@ except Exception as e:
     print(f"Failed to connect to Redis: {e}")
     redis_client = None
 
-# MongoDB connection
-# MongoDB connection
+app = Flask(__name__)
+app.config.from_object('config')
+
+# MongoDB connection used by the Flask routes
 try:
-    client = MongoClient("mongodb://mongo:27017/")
+    client = MongoClient(app.config['MONGO_URI'], maxPoolSize=app.config['MONGO_MAX_POOL_SIZE'])
     db = client['chat_db']
     messages_collection = db['messages']
     # Test connection
     client.admin.command('ping')
     print("Successfully connected to MongoDB.")
+    # history pages walk one room newest first, _id breaks ties between equal timestamps
+    messages_collection.create_index([("room", 1), ("timestamp", DESCENDING), ("_id", DESCENDING)], name="room_timestamp")
 except Exception as e:
     print(f"Failed to connect to MongoDB: {e}")
 
+# async MongoDB client of the websocket server and its batched message writer, created on its event loop by main()
+async_client = None
+async_messages_collection = None
+message_writer = None
+# cross-instance room fan-out and the recent messages of each room, also created by main()
+room_bus = None
+recent_messages = None
+# grpc.aio stub of the animal posts service, balanced over its replicas, also created by main()
+animal_channel = None
+animal_stub = None
+
 # Connect Prometheus
-app = Flask(__name__)
 metrics = PrometheusMetrics(app, defaults_prefix=NO_PREFIX)
 metrics.info('app_info', 'Application info', version='1.0.3')
+slow_client_frames = Counter(
+    'chat_slow_client_frames', 'Broadcast frames refused because the client send queue was full',
+    ['policy'], registry=metrics.registry
+)
 # Global variables
 connected_clients = {}  # Each room will have a set of connected clients
 client_rooms = {}  # Track the room each client is in
-max_concurrent_tasks = 3
-# Semaphore for limiting concurrent tasks
-semaphore = asyncio.Semaphore(max_concurrent_tasks)
-
-channel = grpc.insecure_channel('localhost:50052')
-stub = animal_posts_pb2_grpc.AnimalPostServiceStub(channel)
-
+client_senders = {}  # Outgoing frame queue of each connected client
+# asyncio only keeps weak references to tasks, so pending confirmations are held here until done
+confirm_tasks = set()
+# Semaphore for limiting concurrent message handlers across all connections
+handler_slots = asyncio.Semaphore(app.config['CHAT_MAX_IN_FLIGHT'])
+handlers_in_flight = Gauge('chat_handlers_in_flight', 'Websocket messages being handled', registry=metrics.registry)
+handlers_waiting = Gauge('chat_handlers_waiting', 'Websocket messages waiting for a handler slot', registry=metrics.registry)
+handler_wait_seconds = Histogram(
+    'chat_handler_wait_seconds', 'Time websocket messages waited for a handler slot',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5), registry=metrics.registry
+)
+rejected_messages = Counter('chat_rejected_messages', 'Websocket messages refused by admission control', ['reason'], registry=metrics.registry)
 
 # Register the chat service with a service discovery
 def register_service(service_name, service_url):
@@ -62,47 +99,107 @@ def register_service(service_name, service_url):
         print(f"Failed to register service: {e}")
 
 
+# gRPC target of the animal posts service: configured, else looked up in service discovery. Plain
+# host:port targets are resolved through DNS so every replica behind the name gets calls
+def animal_service_target():
+    target = app.config['ANIMAL_SERVICE_TARGET']
+    if not target:
+        try:
+            response = requests.get(f"{app.config['SERVICE_DISCOVERY_URL']}/services/AnimalService", timeout=2)
+            response.raise_for_status()
+            target = response.json()["url"]
+        except Exception as e:
+            print(f"Failed to discover AnimalService, using {app.config['ANIMAL_SERVICE_DEFAULT_TARGET']}: {e}")
+            target = app.config['ANIMAL_SERVICE_DEFAULT_TARGET']
+    target = target.removeprefix("http://")
+    return target if "://" in target else f"dns:///{target}"
+
+
+# wait for one of the global handler slots, recording how long the message queued for it
+@contextlib.asynccontextmanager
+async def handler_slot():
+    started = time.perf_counter()
+    with handlers_waiting.track_inprogress():
+        await handler_slots.acquire()
+    handler_wait_seconds.observe(time.perf_counter() - started)
+    try:
+        with handlers_in_flight.track_inprogress():
+            yield
+    finally:
+        handler_slots.release()
+
+
 async def handle_client(websocket):
+    client_senders[websocket] = ClientSender(
+        websocket,
+        max_queue=app.config['CHAT_SEND_QUEUE_SIZE'],
+        policy=app.config['CHAT_SLOW_CLIENT_POLICY'],
+        binary=frames.is_binary(websocket)
+    )
+    rate_limit = TokenBucket(app.config['CHAT_RATE_LIMIT'], app.config['CHAT_RATE_BURST'])
     room_name = "lobby" 
-    await join_room(websocket, room_name)  
+    if not await join_room(websocket, room_name):
+        client_senders.pop(websocket).close()
+        await websocket.close(1013, "Room is full")
+        return
 
     try:
         async for message in websocket:
+            if not rate_limit.consume():
+                rejected_messages.labels("rate_limit").inc()
+                await send_message_if_open(websocket, {"error": "Rate limit exceeded, message dropped"})
+                continue
             try:
-                logger.info(message)
-                data = json.loads(message)
-
-                if data.get('action') == 'join_room':
-                    new_room = data.get('room', 'lobby')
-                    await join_room(websocket, new_room)
-                    room_name = new_room  
-                elif data.get('action') == 'get_history':
-                    await send_chat_history(websocket, room_name)
-                elif data.get('action') == 'adopt':
-                    await handle_adopt(data, websocket, room_name)
-                else:
-                    await handle_chat_message(data, websocket, room_name)
-            except json.JSONDecodeError:
-                error_message = json.dumps({"error": "Invalid JSON format"})
-                await websocket.send(error_message)
+                async with handler_slot():
+                    room_name = await handle_message(websocket, message, room_name)
+            except ValueError:
+                # malformed JSON text or msgpack binary frame
+                await send_message_if_open(websocket, {"error": "Invalid message format"})
             except Exception as e:
                 print(f"Error handling message: {e}")
 
     finally:
         await leave_room(websocket, room_name)
+        client_senders.pop(websocket).close()
         print(f"Client disconnected: {websocket.remote_address}")
 
 
+# handle one websocket message, returning the room the client is in afterwards
+async def handle_message(websocket, message, room_name):
+    logger.info(message)
+    data = frames.decode(message)
+
+    if data.get('action') == 'join_room':
+        new_room = data.get('room', 'lobby')
+        if await join_room(websocket, new_room):
+            room_name = new_room
+    elif data.get('action') == 'get_history':
+        await send_chat_history(websocket, room_name, data.get('before'), data.get('limit'))
+    elif data.get('action') == 'adopt':
+        await handle_adopt(data, websocket, room_name)
+    else:
+        await handle_chat_message(data, websocket, room_name)
+    return room_name
+
+
 async def join_room(websocket, room_name):
+    # Refuse rooms already at their member cap on this instance, unless the client is one of the members
+    members = connected_clients.get(room_name, ())
+    if websocket not in members and len(members) >= app.config['CHAT_MAX_ROOM_MEMBERS']:
+        rejected_messages.labels("room_full").inc()
+        await send_message_if_open(websocket, {"error": f"Room {room_name} is full"})
+        return False
+
     # Leave any current room
     current_room = client_rooms.get(websocket)
 
     if current_room:
         await leave_room(websocket, current_room)  # Ensure leaving current room
 
-    # Join the specified room
+    # Join the specified room, listening for its messages from other instances on first local member
     if room_name not in connected_clients:
         connected_clients[room_name] = set()
+        await room_bus.subscribe(room_name)
     connected_clients[room_name].add(websocket)
     client_rooms[websocket] = room_name  # Track which room the client is in
 
@@ -111,6 +208,7 @@ async def join_room(websocket, room_name):
         "system": f"A new user has joined the room: {room_name}"
     }))
     print(f"User joined room {room_name}")
+    return True
 
 
 async def leave_room(websocket, room_name):
@@ -119,6 +217,7 @@ async def leave_room(websocket, room_name):
         connected_clients[room_name].discard(websocket)
         if not connected_clients[room_name]:
             del connected_clients[room_name]  # Clean up empty room
+            await room_bus.unsubscribe(room_name)
 
         # Notify others in the room
         await broadcast_to_room(room_name, json.dumps({
@@ -138,6 +237,8 @@ async def handle_chat_message(data, websocket, room_name):
 
         if not username or not chat_message:
             raise ValueError("Both 'username' and 'message' fields are required.")
+        if not isinstance(username, str) or not isinstance(chat_message, str):
+            raise ValueError("'username' and 'message' must be strings.")
 
         # Save message to the database
         message_record = {
@@ -147,100 +248,286 @@ async def handle_chat_message(data, websocket, room_name):
             "room": room_name,
             "timestamp": datetime.datetime.utcnow()
         }
-        result = messages_collection.insert_one(message_record)
-        logger.info(f"Inserted message with ID: {result.inserted_id} for room {room_name}")
+        # a record BSON can not encode would fail the whole insert_many batch, so it fails here alone
+        bson.encode(message_record)
+        # waits only while the write buffer is full; the confirmation follows once the batch is stored
+        saved = await message_writer.write(message_record)
+        task = asyncio.create_task(confirm_saved(websocket, message_record, saved))
+        confirm_tasks.add(task)
+        task.add_done_callback(confirm_tasks.discard)
+    except Exception as e:
+        logger.error(f"Error in handle_chat_message: {e}")
+        error_message = {
+            "action": "message_saved",
+            "message_id": data.get("message_id"),
+            "status": "failure",
+            "error": str(e)
+        }
+        await send_message_if_open(websocket, error_message)
+
+
+
+
 
-        # Send confirmation back to WebSocket client
+# confirm a chat message to its sender once stored, then fan it out to the room
+async def confirm_saved(websocket, message_record, saved):
+    message_id = message_record["message_id"]
+    try:
+        await saved
         confirmation_message = {
             "action": "message_saved",
             "message_id": message_id,
             "status": "success"
         }
-        logger.info(f"Sending confirmation: {confirmation_message}")
-        await websocket.send(json.dumps(confirmation_message))
     except Exception as e:
-        logger.error(f"Error in handle_chat_message: {e}")
-        error_message = {
+        logger.error(f"Failed to save message {message_id}: {e}")
+        confirmation_message = {
             "action": "message_saved",
-            "message_id": data.get("message_id"),
+            "message_id": message_id,
             "status": "failure",
             "error": str(e)
         }
-        await websocket.send(json.dumps(error_message))
-
-
+    # Send confirmation back to WebSocket client
+    logger.info(f"Sending confirmation: {confirmation_message}")
+    await send_message_if_open(websocket, confirmation_message)
 
+    if confirmation_message["status"] == "success":
+        await broadcast_to_room(message_record["room"], json.dumps({
+            "action": "chat_message",
+            "message_id": message_id,
+            "username": message_record["username"],
+            "message": message_record["message"],
+            "timestamp": message_record["timestamp"].isoformat()
+        }))
 
 
 async def handle_adopt(data, websocket, room_name):
     username = data.get('username')
     animal_id = data.get('animal_id')
+    result = {"action": "adopt_result", "animal_id": animal_id}
 
-    async with client.start_session() as session:
-        session.start_transaction()
-
-        message_record = {
-            "username": username,
-            "message": 'adopt',
-            "room": room_name,
-            "timestamp": datetime.datetime.utcnow()
-        }
-        messages_collection.insert_one(message_record)
-        try:
-            response = stub.AdoptAnimal({"postId": animal_id})
-            response.raise_for_status()
-        except Exception as e:
-            print(f"Error on adoption process: {e}")
-            session.abort_transaction()
-        else:
-            session.commit_transaction()
+    try:
+        adopt_request = animal_posts_pb2.AdoptAnimalRequest(postId=int(animal_id))
+        async with async_client.start_session() as session:
+            # the adoption message is committed only if the animal service adopted the animal,
+            # any error below aborts the transaction
+            async with await session.start_transaction():
+                message_record = {
+                    "username": username,
+                    "message": 'adopt',
+                    "room": room_name,
+                    "timestamp": datetime.datetime.utcnow()
+                }
+                await async_messages_collection.insert_one(message_record, session=session)
+                response = await animal_stub.AdoptAnimal(adopt_request, timeout=app.config['ADOPT_TIMEOUT'])
+                if response.status_code != 200:
+                    raise RuntimeError(response.status)
+        await recent_messages.push(room_name, history_entry(message_record))
+        result.update(status="success", message=response.status)
+    except grpc.aio.AioRpcError as e:
+        # e.g. FAILED_PRECONDITION when the animal was already adopted, DEADLINE_EXCEEDED on timeout
+        print(f"Error on adoption process: {e.code().name} {e.details()}")
+        result.update(status="failure", error=e.details() or e.code().name)
+    except Exception as e:
+        print(f"Error on adoption process: {e}")
+        result.update(status="failure", error=str(e))
+    await send_message_if_open(websocket, result)
 
 
+# send a message to all clients of a room, on every instance
 async def broadcast_to_room(room_name, message):
-    # Send a message to all clients in a specific room
-    if room_name in connected_clients:
-        tasks = []
-        for client in connected_clients[room_name]:
-            # Check if the client connection is still open
-            tasks.append(
-                asyncio.create_task(send_message_if_open(client, message))
-            )
-        await asyncio.gather(*tasks)
-
-
-async def send_message_if_open(client, message):
+    await room_bus.publish(room_name, message)
+
+
+async def deliver_to_local_members(room_name, message):
+    # Queue a message for the clients of a specific room connected to this instance, encoded once per protocol
+    members = connected_clients.get(room_name)
+    if not members:
+        return
+    encoded = {False: message.encode()}
+    closed = []
+    for client in members:
+        sender = client_senders.get(client)
+        if sender is None or sender.closed:
+            closed.append(client)
+            continue
+        if sender.binary not in encoded:
+            encoded[True] = frames.transcode(message)
+        if not sender.send(encoded[sender.binary]):
+            slow_client_frames.labels(sender.policy).inc()
+    # prune connections that went away, leave_room completes their cleanup
+    members.difference_update(closed)
+
+
+async def send_message_if_open(client, payload):
     try:
-        # Attempt to send a message, and ignore clients that have closed the connection
-        await client.send(message)
+        # Attempt to send a message in the client's protocol, and ignore clients that have closed the connection
+        binary = frames.is_binary(client)
+        await client.send(frames.encode(payload, binary), text=not binary)
     except websockets.exceptions.ConnectionClosed:
         # If the connection is closed, do nothing (or log if necessary)
         print(f"Connection closed for {client.remote_address}")
 
 
-async def send_chat_history(websocket, room_name):
+async def send_chat_history(websocket, room_name, before=None, limit=None):
     try:
         # Set a timeout
-        await asyncio.wait_for(retrieve_and_send_history(websocket, room_name), timeout=5.0)
+        await asyncio.wait_for(retrieve_and_send_history(websocket, room_name, before, limit), timeout=5.0)
     except asyncio.TimeoutError:
         print("Time out")
-        await websocket.send(json.dumps({"error": "Could not retrieve chat history within the timeout"}))
+        await send_message_if_open(websocket, {"error": "Could not retrieve chat history within the timeout"})
+    except ValueError as e:
+        # a malformed cursor or limit
+        await send_message_if_open(websocket, {"error": str(e)})
+
+
+async def retrieve_and_send_history(websocket, room_name, before=None, limit=None):
+    query, limit = history_query(room_name, before, limit)
+    # the latest page usually comes from the room's buffer in Redis
+    page = await recent_messages.latest(room_name, limit) if not before else None
+    if page is not None:
+        history, older = page
+    else:
+        # Retrieve one page of chat history from MongoDB for the specific room
+        messages = await (
+            async_messages_collection.find(query, HISTORY_PROJECTION).sort(HISTORY_SORT).limit(limit + 1).to_list()
+        )
+        history, older = format_history(messages, limit)
+        if not before:
+            await recent_messages.warm(room_name, [history_entry(message) for message in messages], complete=older is None)
+
+    # Send the chat history back to the requesting client, with the cursor of the previous page
+    await send_message_if_open(websocket, {"action": "chat_history", "history": history, "before": older})
+
+
+# history cursors point at the oldest message already sent: "<timestamp ms>_<ObjectId>"
+def encode_history_cursor(message):
+    timestamp = message["timestamp"].replace(tzinfo=datetime.timezone.utc)
+    return f"{int(timestamp.timestamp() * 1000)}_{message['_id']}"
+
+
+def decode_history_cursor(cursor):
+    try:
+        millis, message_id = cursor.split("_", 1)
+        timestamp = datetime.datetime.fromtimestamp(int(millis) / 1000, datetime.timezone.utc).replace(tzinfo=None)
+        return timestamp, ObjectId(message_id)
+    except Exception as e:
+        raise ValueError(f"Invalid history cursor: {cursor}") from e
+
+
+HISTORY_PROJECTION = {"username": 1, "message": 1, "timestamp": 1}
+HISTORY_SORT = [("timestamp", DESCENDING), ("_id", DESCENDING)]
+
 
+# the page size asked for, from JSON or a query string, within the configured bounds
+def parse_history_limit(limit):
+    if not limit:
+        return app.config['CHAT_HISTORY_PAGE_SIZE']
+    try:
+        if isinstance(limit, bool) or not isinstance(limit, (int, str)):
+            raise TypeError
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid history limit: {limit}") from None
+    return max(1, min(limit, app.config['CHAT_HISTORY_MAX_PAGE_SIZE']))
+
+
+# return (filter, page size) selecting the latest messages of a room before a cursor
+def history_query(room_name, before=None, limit=None):
+    limit = parse_history_limit(limit)
+
+    query = {"room": room_name}
+    if before:
+        timestamp, message_id = decode_history_cursor(before)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": message_id}}
+        ]
+    return query, limit
+
+
+# return (messages oldest first, cursor of the previous page or None) from up to limit + 1 newest-first
+# messages; the extra message only tells whether an older page exists
+def format_history(messages, limit):
+    older = encode_history_cursor(messages[limit - 1]) if len(messages) > limit else None
+    history = [history_entry(message, with_cursor=False) for message in reversed(messages[:limit])]
+    return history, older
+
+
+# a stored message as sent in history, optionally with the cursor the recent messages buffer keeps
+def history_entry(message, with_cursor=True):
+    entry = {
+        "username": message.get("username", ""),
+        "message": message.get("message", ""),
+        "timestamp": message["timestamp"].isoformat()
+    }
+    if with_cursor:
+        entry["cursor"] = encode_history_cursor(message)
+    return entry
+
+
+# add the messages of a stored batch to the recent messages buffer in write order, which is
+# the order of their history cursors; insert_many filled in the _id each cursor needs
+async def buffer_stored_batch(message_records):
+    await recent_messages.push_many([(record["room"], history_entry(record)) for record in message_records])
+
+
+# add a message stored by a Flask route to the recent messages buffer, which lives on the websocket loop
+def buffer_stored_message(message_record):
+    if recent_messages is not None:
+        asyncio.run_coroutine_threadsafe(
+            recent_messages.push(message_record["room"], history_entry(message_record)), websocket_loop
+        )
 
-async def retrieve_and_send_history(websocket, room_name):
-    # Retrieve chat history from MongoDB for the specific room
-    messages = list(messages_collection.find({"room": room_name}).sort("timestamp", 1))
-    history = [{"username": message['username'], "message": message['message']} for message in messages]
 
-    # Send the chat history back to the requesting client
-    history_message = json.dumps({"action": "chat_history", "history": history})
-    await websocket.send(history_message)
+def fetch_history(room_name, before=None, limit=None):
+    query, limit = history_query(room_name, before, limit)
+    messages = list(messages_collection.find(query, HISTORY_PROJECTION).sort(HISTORY_SORT).limit(limit + 1))
+    return format_history(messages, limit)
 
 
 async def main():
+    global async_client, async_messages_collection, message_writer, room_bus, recent_messages, animal_channel, animal_stub
+    # non-blocking driver, so a slow Mongo call only delays the handler that made it
+    async_client = AsyncMongoClient(app.config['MONGO_URI'], maxPoolSize=app.config['MONGO_MAX_POOL_SIZE'])
+    async_messages_collection = async_client['chat_db']['messages']
+    message_writer = MessageWriter(
+        async_messages_collection,
+        batch_size=app.config['CHAT_WRITE_BATCH_SIZE'],
+        linger=app.config['CHAT_WRITE_LINGER_MS'] / 1000,
+        max_pending=app.config['CHAT_WRITE_MAX_PENDING'],
+        on_stored=buffer_stored_batch
+    )
+    message_writer.start()
+    async_redis = redis.asyncio.Redis(host='redis', port=6379) if redis_client is not None else None
+    room_bus = RoomBus(async_redis, deliver_to_local_members)
+    room_bus.start()
+    recent_messages = RecentMessages(async_redis, size=app.config['CHAT_RECENT_MESSAGES'], ttl=app.config['CHAT_RECENT_TTL'])
+
+    animal_channel = grpc.aio.insecure_channel(
+        await asyncio.to_thread(animal_service_target),
+        options=[("grpc.lb_policy_name", "round_robin")]
+    )
+    animal_stub = animal_posts_pb2_grpc.AnimalPostServiceStub(animal_channel)
+
     register_service("ChatService", "ws://new_chat:6789")
-    async with websockets.serve(handle_client, "new_chat", 6789):
-        print("WebSocket server running on ws://new_chat:6789")
-        await asyncio.Future()
+    try:
+        # frames above max_size are refused by the protocol layer with close code 1009; clients may
+        # negotiate msgpack frames and permessage-deflate, others keep plain JSON text frames
+        async with websockets.serve(
+            handle_client, "new_chat", 6789,
+            max_size=app.config['CHAT_MAX_MESSAGE_BYTES'],
+            subprotocols=[frames.MSGPACK, frames.JSON],
+            select_subprotocol=frames.select_subprotocol,
+            compression=app.config['CHAT_COMPRESSION'] or None
+        ):
+            print("WebSocket server running on ws://new_chat:6789")
+            await asyncio.Future()
+    finally:
+        # store messages still buffered before the process exits
+        await message_writer.close()
+        await room_bus.close()
+        await animal_channel.close()
 
 
 from threading import Thread
@@ -281,6 +568,7 @@ def add_test_message():
         }
         # Insert the message into the database
         result = messages_collection.insert_one(test_message)
+        buffer_stored_message(test_message)
         return {
             "status": "success",
             "message": "Test message added to database",
@@ -292,17 +580,11 @@ def add_test_message():
 @app.route("/get_messages/<room_name>", methods=["GET"])
 def get_messages(room_name):
     try:
-        # Fetch messages for the given room from MongoDB
-        messages = list(messages_collection.find({"room": room_name}).sort("timestamp", 1))
-        formatted_messages = [
-            {
-                "username": message.get("username", ""),
-                "message": message.get("message", ""),
-                "timestamp": message.get("timestamp", "").isoformat()
-            }
-            for message in messages
-        ]
-        return {"status": "success", "messages": formatted_messages}, 200
+        # Fetch the latest messages for the given room from MongoDB, ?before= pages back in time
+        formatted_messages, older = fetch_history(room_name, request.args.get("before"), request.args.get("limit"))
+        return {"status": "success", "messages": formatted_messages, "before": older}, 200
+    except ValueError as e:
+        return {"status": "failure", "error": str(e)}, 400
     except Exception as e:
         return {"status": "failure", "error": str(e)}, 500
 
@@ -333,6 +615,7 @@ def add_message():
 
         # Insert the message into MongoDB
         result = messages_collection.insert_one(message_record)
+        buffer_stored_message(message_record)
         return {
             "status": "success",
             "message": "Message added to database",
@@ -405,6 +688,7 @@ def commit_transaction():
         }
         print(f"=== /commit: Saving message to database. Record: {message_record} ===")
         result = messages_collection.insert_one(message_record)
+        buffer_stored_message(message_record)
         print(f"=== /commit: Message saved to database with ID: {result.inserted_id} ===")
 
         # Release the lock in Redis
@@ -445,19 +729,38 @@ def rollback_transaction():
         print(f"=== /rollback: Error in rollback_transaction: {e} ===")
         return {"status": "failed", "reason": str(e)}, 500
 
+websocket_loop = asyncio.new_event_loop()
+websocket_main = None
+
+
 def start_websocket_server():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(main())
+    global websocket_main
+    asyncio.set_event_loop(websocket_loop)
+    websocket_main = websocket_loop.create_task(main())
+    try:
+        websocket_loop.run_until_complete(websocket_main)
+    except asyncio.CancelledError:
+        pass
+
+
+# cancel main() on the websocket loop, which flushes the message writer on its way out
+def stop_websocket_server():
+    if websocket_main is not None:
+        websocket_loop.call_soon_threadsafe(websocket_main.cancel)
 
 
 if __name__ == "__main__":
+    # turn docker's SIGTERM into a normal exit so buffered messages are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    websocket_thread = Thread(target=start_websocket_server)
     try:
         # Start WebSocket server in a separate thread
-        websocket_thread = Thread(target=start_websocket_server)
         websocket_thread.start()
 
         # Start Flask app for Prometheus metrics
         app.run(host="0.0.0.0", port=9100)
     except KeyboardInterrupt:
         print("Server is shutting down...")
+    finally:
+        stop_websocket_server()
+        websocket_thread.join()
@@ -0,0 +1,355 @@
+import asyncio
+import datetime
+import json
+import unittest
+from unittest.mock import AsyncMock, patch
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+import msgpack
+import websockets
+import frames
+from write_behind import MessageWriter
+from broadcast import ClientSender
+from admission import TokenBucket
+from recent_messages import RecentMessages
+
+import fakeredis
+
+# the server connects to MongoDB and Redis on import, the handlers under test get their clients patched in
+try:
+    with patch('pymongo.MongoClient'), patch('redis.Redis'):
+        import server
+except ImportError:
+    server = None
+
+
+def history_item(i):
+    return {"username": "u", "message": f"m{i}", "timestamp": f"2024-01-01T00:00:{i:02d}", "cursor": f"{i}_id"}
+
+
+class TestMessageWriter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.collection = AsyncMock()
+
+    async def test_writes_are_stored_in_batches(self):
+        writer = MessageWriter(self.collection, batch_size=2, linger=0.01)
+        saved = [await writer.write({"message": i}) for i in range(3)]
+        writer.start()
+
+        self.assertEqual(await asyncio.gather(*saved), [True, True, True])
+        batches = [call.args[0] for call in self.collection.insert_many.call_args_list]
+        self.assertEqual(batches, [[{"message": 0}, {"message": 1}], [{"message": 2}]])
+        await writer.close()
+
+    async def test_bulk_write_error_fails_only_its_messages(self):
+        self.collection.insert_many.side_effect = BulkWriteError({
+            "writeErrors": [{"index": 1, "errmsg": "duplicate key"}]
+        })
+        writer = MessageWriter(self.collection, batch_size=2, linger=0)
+        first, second = await writer.write({"message": 0}), await writer.write({"message": 1})
+        writer.start()
+
+        self.assertTrue(await first)
+        with self.assertRaisesRegex(Exception, "duplicate key"):
+            await second
+        await writer.close()
+
+    async def test_full_buffer_blocks_writers(self):
+        writer = MessageWriter(self.collection, batch_size=10, linger=0, max_pending=1)
+        await writer.write({"message": 0})
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(writer.write({"message": 1}), timeout=0.05)
+
+        # the writer frees the buffer once it stores the waiting batch
+        writer.start()
+        saved = await asyncio.wait_for(writer.write({"message": 2}), timeout=1)
+        self.assertTrue(await saved)
+        await writer.close()
+
+    async def test_stored_records_are_handed_on_in_write_order(self):
+        self.collection.insert_many.side_effect = BulkWriteError({
+            "writeErrors": [{"index": 1, "errmsg": "duplicate key"}]
+        })
+        stored = []
+        writer = MessageWriter(self.collection, batch_size=3, linger=0, on_stored=AsyncMock(side_effect=stored.extend))
+        saved = [await writer.write({"message": i}) for i in range(3)]
+        writer.start()
+
+        await asyncio.gather(*saved, return_exceptions=True)
+        self.assertEqual(stored, [{"message": 0}, {"message": 2}])
+        await writer.close()
+
+    async def test_close_flushes_buffered_messages(self):
+        writer = MessageWriter(self.collection, batch_size=100, linger=0.01)
+        writer.start()
+        saved = [await writer.write({"message": i}) for i in range(3)]
+
+        await writer.close()
+        self.assertTrue(all(future.done() and future.result() for future in saved))
+        self.collection.insert_many.assert_awaited()
+        with self.assertRaises(RuntimeError):
+            await writer.write({"message": 3})
+
+
+class TestFrames(unittest.TestCase):
+
+    def test_json_and_msgpack_frames_decode_alike(self):
+        data = {"username": "u", "message": "hi", "before": None, "limit": 10}
+        self.assertEqual(frames.decode(json.dumps(data)), data)
+        self.assertEqual(frames.decode(msgpack.packb(data)), data)
+
+    def test_frames_without_a_json_object_are_rejected(self):
+        for frame in [
+            json.dumps(["u", "hi"]),
+            json.dumps({"username": "u", "message": 5}),
+            msgpack.packb({"username": "u", "message": b"hi"}),
+            msgpack.packb({"username": "u", "message": "hi", "message_id": msgpack.ExtType(1, b"x")}),
+            msgpack.packb({"username": "u", "message": "hi", "tags": [b"x"]}),
+        ]:
+            with self.assertRaises(ValueError):
+                frames.decode(frame)
+
+
+class TestClientSender(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.websocket = AsyncMock()
+
+    async def test_frames_are_sent_in_order(self):
+        sender = ClientSender(self.websocket, max_queue=10, binary=True)
+        for frame in (b"a", b"b", b"c"):
+            self.assertTrue(sender.send(frame))
+        await asyncio.sleep(0)
+
+        self.assertEqual([call.args[0] for call in self.websocket.send.call_args_list], [b"a", b"b", b"c"])
+        self.assertEqual(self.websocket.send.call_args.kwargs, {"text": False})
+        sender.close()
+
+    async def test_drop_policy_discards_frames_beyond_the_queue(self):
+        # nothing is sent before the sender task first runs, so the queue fills up
+        sender = ClientSender(self.websocket, max_queue=2, policy="drop")
+        self.assertEqual([sender.send(frame) for frame in (b"a", b"b", b"c")], [True, True, False])
+        await asyncio.sleep(0)
+
+        self.assertEqual([call.args[0] for call in self.websocket.send.call_args_list], [b"a", b"b"])
+        self.assertFalse(sender.closed)
+        self.websocket.close.assert_not_called()
+        sender.close()
+
+    async def test_disconnect_policy_closes_slow_clients(self):
+        sender = ClientSender(self.websocket, max_queue=1, policy="disconnect")
+        self.assertTrue(sender.send(b"a"))
+        self.assertFalse(sender.send(b"b"))
+        await asyncio.sleep(0)
+
+        self.assertTrue(sender.closed)
+        self.websocket.close.assert_awaited_once_with(1013, "Client too slow")
+        self.assertFalse(sender.send(b"c"))
+        sender.close()
+
+    async def test_closed_connection_marks_the_sender_closed(self):
+        self.websocket.send.side_effect = websockets.exceptions.ConnectionClosed(None, None)
+        sender = ClientSender(self.websocket)
+        sender.send(b"a")
+        await asyncio.sleep(0)
+
+        self.assertTrue(sender.closed)
+        self.assertFalse(sender.send(b"b"))
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    @patch('admission.time.monotonic')
+    def test_bursts_then_refills_at_the_rate(self, monotonic):
+        monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+        monotonic.return_value = 100.5
+        self.assertEqual([bucket.consume() for _ in range(2)], [True, False])
+
+        # an idle connection saves up no more than the burst
+        monotonic.return_value = 200.0
+        self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+
+# runs the warm script, so it needs fakeredis with Lua support (fakeredis[lua], see requirements-test.txt)
+class TestRecentMessages(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.recent = RecentMessages(fakeredis.FakeAsyncRedis(), size=5, ttl=60)
+
+    async def test_small_room_is_served_whole_after_warm(self):
+        await self.recent.warm("lobby", [history_item(2), history_item(1)], complete=True)
+
+        history, older = await self.recent.latest("lobby", 3)
+        self.assertEqual([entry["message"] for entry in history], ["m1", "m2"])
+        self.assertIsNone(older)
+        self.assertNotIn("cursor", history[0])
+
+    async def test_partial_buffer_is_a_miss(self):
+        await self.recent.push("lobby", history_item(1))
+        await self.recent.push("lobby", history_item(2))
+
+        self.assertIsNone(await self.recent.latest("lobby", 3))
+
+    async def test_push_many_keeps_the_order_of_each_room(self):
+        await self.recent.push_many([("lobby", history_item(i)) for i in range(1, 7)] + [("garden", history_item(7))])
+
+        history, older = await self.recent.latest("lobby", 3)
+        self.assertEqual([entry["message"] for entry in history], ["m4", "m5", "m6"])
+        self.assertEqual(older, "4_id")
+        self.assertEqual(await self.recent.client.llen(self.recent.key("lobby")), 5)
+        self.assertEqual(await self.recent.client.llen(self.recent.key("garden")), 1)
+
+    async def test_full_page_points_at_the_previous_page(self):
+        for i in range(1, 5):
+            await self.recent.push("lobby", history_item(i))
+
+        history, older = await self.recent.latest("lobby", 2)
+        self.assertEqual([entry["message"] for entry in history], ["m3", "m4"])
+        self.assertEqual(older, "3_id")
+
+    async def test_warm_replaces_a_buffer_covered_by_the_read(self):
+        await self.recent.push("lobby", history_item(2))
+
+        await self.recent.warm("lobby", [history_item(2), history_item(1)], complete=True)
+        history, _ = await self.recent.latest("lobby", 3)
+        self.assertEqual([entry["message"] for entry in history], ["m1", "m2"])
+
+    async def test_warm_keeps_messages_pushed_after_the_read(self):
+        await self.recent.push("lobby", history_item(3))
+
+        await self.recent.warm("lobby", [history_item(2), history_item(1)], complete=True)
+        self.assertIsNone(await self.recent.latest("lobby", 3))
+        self.assertEqual(await self.recent.client.llen(self.recent.key("lobby")), 1)
+
+    async def test_trimming_drops_the_history_start(self):
+        await self.recent.warm("lobby", [history_item(2), history_item(1)], complete=True)
+        for i in range(3, 5):
+            await self.recent.push("lobby", history_item(i))
+
+        history, older = await self.recent.latest("lobby", 4)
+        self.assertEqual([entry["message"] for entry in history], ["m1", "m2", "m3", "m4"])
+        self.assertIsNone(older)
+
+        # the buffer holds 5 entries, so the next push trims the marker and m1 becomes an older page
+        await self.recent.push("lobby", history_item(5))
+        history, older = await self.recent.latest("lobby", 4)
+        self.assertEqual([entry["message"] for entry in history], ["m2", "m3", "m4", "m5"])
+        self.assertEqual(older, "2_id")
+
+
+@unittest.skipIf(server is None, "server dependencies are not installed")
+class TestChatMessages(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.collection = AsyncMock()
+        # like the driver, insert_many fills in the _id of each record
+        self.collection.insert_many.side_effect = lambda records, ordered: [record.setdefault("_id", ObjectId()) for record in records]
+        self.writer = MessageWriter(self.collection, batch_size=10, linger=0)
+        for name, value in {"message_writer": self.writer, "room_bus": AsyncMock(), "recent_messages": AsyncMock()}.items():
+            patcher = patch.object(server, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def websocket():
+        websocket = AsyncMock()
+        websocket.subprotocol = None
+        return websocket
+
+    @staticmethod
+    def replies(websocket):
+        return [json.loads(call.args[0]) for call in websocket.send.call_args_list]
+
+    async def test_unencodable_message_fails_alone(self):
+        good, bad = self.websocket(), self.websocket()
+        await server.handle_chat_message({"username": "u", "message": "a"}, good, "lobby")
+        # BSON only holds 8-byte ints
+        await server.handle_chat_message({"username": "u", "message": "b", "message_id": 10 ** 30}, bad, "lobby")
+        await server.handle_chat_message({"username": "u", "message": 10 ** 30}, bad, "lobby")
+        await server.handle_chat_message({"username": "u", "message": "c"}, good, "lobby")
+        self.writer.start()
+        await self.writer.close()
+        await asyncio.gather(*list(server.confirm_tasks))
+
+        batch = self.collection.insert_many.call_args.args[0]
+        self.assertEqual([record["message"] for record in batch], ["a", "c"])
+        self.assertEqual([reply["status"] for reply in self.replies(good)], ["success", "success"])
+        self.assertEqual([reply["status"] for reply in self.replies(bad)], ["failure", "failure"])
+
+    async def test_full_room_refuses_new_members_only(self):
+        member, newcomer = self.websocket(), self.websocket()
+        with patch.dict(server.app.config, {"CHAT_MAX_ROOM_MEMBERS": 1}), \
+                patch.dict(server.connected_clients, {"lobby": {member}}), patch.dict(server.client_rooms, {member: "lobby"}):
+            self.assertFalse(await server.join_room(newcomer, "lobby"))
+            self.assertTrue(await server.join_room(member, "lobby"))
+            self.assertEqual(server.connected_clients["lobby"], {member})
+        self.assertEqual(self.replies(newcomer), [{"error": "Room lobby is full"}])
+
+    async def test_handler_slots_bound_and_measure_waiting_messages(self):
+        def value(metric):
+            return server.metrics.registry.get_sample_value(metric)
+
+        release = asyncio.Event()
+
+        async def handle():
+            async with server.handler_slot():
+                await release.wait()
+
+        waits = value("chat_handler_wait_seconds_count")
+        with patch.object(server, "handler_slots", asyncio.Semaphore(1)):
+            handlers = [asyncio.create_task(handle()) for _ in range(2)]
+            await asyncio.sleep(0)
+            self.assertEqual(value("chat_handlers_in_flight"), 1)
+            self.assertEqual(value("chat_handlers_waiting"), 1)
+
+            release.set()
+            await asyncio.gather(*handlers)
+        self.assertEqual(value("chat_handlers_in_flight"), 0)
+        self.assertEqual(value("chat_handlers_waiting"), 0)
+        self.assertEqual(value("chat_handler_wait_seconds_count"), waits + 2)
+
+    def test_history_cursor_round_trip(self):
+        message = {"_id": ObjectId(), "timestamp": datetime.datetime(2024, 5, 1, 12, 30, 15, 123000)}
+
+        cursor = server.encode_history_cursor(message)
+        self.assertEqual(server.decode_history_cursor(cursor), (message["timestamp"], message["_id"]))
+        for cursor in ("", "123", "abc_" + str(message["_id"]), "123_not-an-id"):
+            with self.assertRaisesRegex(ValueError, "Invalid history cursor"):
+                server.decode_history_cursor(cursor)
+
+    def test_history_limit_is_validated_separately(self):
+        self.assertEqual(server.history_query("lobby", limit="10")[1], 10)
+        self.assertEqual(server.history_query("lobby")[1], server.app.config['CHAT_HISTORY_PAGE_SIZE'])
+        self.assertEqual(server.history_query("lobby", limit=10 ** 6)[1], server.app.config['CHAT_HISTORY_MAX_PAGE_SIZE'])
+        for limit in ("ten", [10], 1.5, True):
+            with self.assertRaisesRegex(ValueError, "Invalid history limit"):
+                server.history_query("lobby", limit=limit)
+
+    async def test_bad_history_limit_gets_its_own_error(self):
+        websocket = self.websocket()
+        await server.send_chat_history(websocket, "lobby", limit=[10])
+        self.assertEqual(self.replies(websocket), [{"error": "Invalid history limit: [10]"}])
+
+    async def test_delivery_prunes_closed_connections(self):
+        live, gone = self.websocket(), self.websocket()
+        senders = {live: ClientSender(live), gone: ClientSender(gone)}
+        senders[gone].closed = True
+        members = {live, gone}
+
+        with patch.dict(server.client_senders, senders), patch.dict(server.connected_clients, {"lobby": members}):
+            await server.deliver_to_local_members("lobby", '{"message": "hi"}')
+            await asyncio.sleep(0)
+        self.assertEqual(members, {live})
+        live.send.assert_awaited_once_with(b'{"message": "hi"}', text=True)
+        gone.send.assert_not_called()
+        for sender in senders.values():
+            sender.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#new_chat/write_behind.py
+import asyncio
+from pymongo.errors import BulkWriteError
+
+
+# write-behind buffer storing chat messages with batched insert_many calls
+class MessageWriter:
+    def __init__(self, collection, batch_size=500, linger=0.005, max_pending=10000, on_stored=None):
+        self.collection = collection
+        # awaited with the records of each flush that were stored, in write order
+        self.on_stored = on_stored
+        self.batch_size = batch_size
+        self.linger = linger
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.closed = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    # queue a record, waiting while the buffer is full; the returned future resolves once it is stored
+    async def write(self, record):
+        if self.closed:
+            raise RuntimeError("Message writer is closed")
+        saved = asyncio.get_running_loop().create_future()
+        await self.queue.put((record, saved))
+        return saved
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        await self.queue.put(None)
+        await self._task
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            # leave the window open for more messages unless a full batch is already waiting
+            if batch[0] is not None and self.linger > 0 and self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.linger)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            stopping = None in batch
+            await self._flush([entry for entry in batch if entry is not None])
+            if stopping:
+                # the writer is closed, so nothing can be queued behind the sentinel
+                while not self.queue.empty():
+                    entry = self.queue.get_nowait()
+                    if entry is not None:
+                        await self._flush([entry])
+                return
+
+    async def _flush(self, batch):
+        if not batch:
+            return
+        errors = {}
+        try:
+            # unordered, so one bad message does not stop the rest of the batch
+            await self.collection.insert_many([record for record, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            errors = {error["index"]: Exception(error.get("errmsg", "write failed")) for error in e.details.get("writeErrors", [])}
+            if not errors:
+                errors = dict.fromkeys(range(len(batch)), e)
+        except Exception as e:
+            errors = dict.fromkeys(range(len(batch)), e)
+
+        if self.on_stored is not None:
+            stored = [record for index, (record, _) in enumerate(batch) if index not in errors]
+            try:
+                if stored:
+                    await self.on_stored(stored)
+            except Exception as e:
+                print(f"Failed to hand on stored messages: {e}")
+
+        for index, (_, saved) in enumerate(batch):
+            # the writer may have stopped waiting, e.g. its connection closed
+            if saved.done():
+                continue
+            if index in errors:
+                saved.set_exception(errors[index])
+            else:
+                saved.set_result(True)